@@ -0,0 +1,141 @@
+"""belief_cache.py
+
+Cache of worker beliefs, so that a new answer extends a cached belief by
+one step instead of replaying the worker's whole history.
+
+"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import numpy as np
+from . import util
+
+
+def fingerprint(steps, digest=''):
+    """Return digest of a sequence of (action, observation, ...) tuples.
+
+    Digests are chained, so the digest of a longer sequence can be computed
+    from the digest of a prefix and the remaining steps only.
+
+    >>> fingerprint([(1, 0, None)]) == fingerprint([(1, 0)])
+    True
+    >>> fingerprint([(1, 0)]) == fingerprint([(2, 3)])
+    False
+    >>> fingerprint([(2, 3)], fingerprint([(1, 0)])) == \\
+    ...     fingerprint([(1, 0), (2, 3)])
+    True
+
+    """
+    for step in steps:
+        digest = hashlib.sha1('{}:{}:{}'.format(
+            digest, int(step[0]), int(step[1])).encode('utf-8')).hexdigest()
+    return digest
+
+
+class BeliefCache(object):
+    """LRU cache of beliefs, keyed by worker.
+
+    Each entry stores the number of steps the belief accounts for, a
+    chained fingerprint of those steps, and the last of them. Histories are
+    assumed to be append-only: a lookup with a longer history whose step at
+    the cached length matches the cached last step extends the cached
+    belief and fingerprint with only the new steps, so each lookup costs
+    time proportional to the new steps. Anything else (new worker,
+    truncated history, changed last step) falls back to a full replay from
+    the start belief.
+
+    """
+    def __init__(self, maxsize=10000, path=None):
+        """Initialize.
+
+        Args:
+            maxsize (int):  Maximum number of entries kept in memory.
+            path (str):     Optional directory for an on-disk copy of
+                            every entry, shared across processes and
+                            restarts.
+
+        """
+        self.maxsize = maxsize
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            util.ensure_dir(path)
+
+    def _filepath(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.npz'.format(name))
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.path is None:
+            return None
+        try:
+            with np.load(self._filepath(key)) as f:
+                entry = (int(f['n']), str(f['digest']),
+                         tuple(f['last'].tolist()), f['belief'])
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        self._put(key, entry, write=False)
+        return entry
+
+    def _put(self, key, entry, write=True):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        if write and self.path is not None:
+            n, digest, last, belief = entry
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, n=n, digest=digest, last=np.array(last),
+                         belief=belief)
+            os.rename(tmp, self._filepath(key))
+
+    def get_belief(self, model, key, steps):
+        """Return belief of model after steps, reusing any cached prefix.
+
+        Args:
+            model (POMDPModel):     Model used to update beliefs. Include
+                                    anything identifying its parameters in
+                                    key.
+            key:                    Hashable key, e.g. (model key, worker id).
+            steps:                  List of (action, observation, ...) tuples.
+
+        Returns:
+            Belief (numpy array).
+
+        """
+        entry = self._get(key)
+        if entry is not None:
+            n, digest, last, belief = entry
+            if (0 < n <= len(steps) and
+                    tuple(int(x) for x in steps[n - 1][:2]) == last):
+                if n == len(steps):
+                    return belief
+                steps_new = steps[n:]
+            else:
+                entry = None
+        if entry is None:
+            digest = ''
+            belief = model.get_start_belief()
+            steps_new = steps
+        if not steps:
+            return np.asarray(belief, dtype=float)
+        for step in steps_new:
+            belief = model.update_belief(belief, step[0], step[1])
+        belief = np.asarray(belief, dtype=float)
+        self._put(key, (len(steps), fingerprint(steps_new, digest),
+                        tuple(int(x) for x in steps[-1][:2]), belief))
+        return belief
+
+    def clear(self):
+        """Remove all in-memory entries."""
+        with self._lock:
+            self._entries.clear()
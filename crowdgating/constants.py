@@ -58,6 +58,7 @@ DEFAULT_GATING_PARAMS = {
     'desired_accuracy': 0.8,
     'gold_per_batch': 5,
     'exponential_backoff': True,
+    'gold_schedule': 'shuffle',
     'n_tutorial': 0,
     'n_screening': 0,
 }
@@ -0,0 +1,137 @@
+"""ess_cache.py
+
+Cache of expected sufficient statistics totals, so that a warm-started EM
+run does not redo the E-step for workers whose data and parameters have
+not changed.
+
+"""
+import collections
+import hashlib
+import threading
+import numpy as np
+from .pomdp import params_key
+
+
+def get_params_version(params):
+    """Return digest identifying parameter values.
+
+    >>> get_params_version({'p': [0.5, 0.5]}) == \\
+    ...     get_params_version({'p': [0.5, 0.5]})
+    True
+    >>> get_params_version({'p': [0.5, 0.5]}) == \\
+    ...     get_params_version({'p': [0.4, 0.6]})
+    False
+
+    """
+    return hashlib.sha1(repr(params_key(params)).encode('utf-8')).hexdigest()
+
+
+class ESSCache(object):
+    """LRU cache of E-step totals, keyed by parameter version.
+
+    Each entry holds the expected sufficient statistics summed over a set
+    of workers, identified by their number of steps in row order. When EM
+    is warm-started from the parameters of the last run (see
+    POMDPModel.estimate(last_params=True)), the first E-step reuses the
+    totals stored at the end of that run and only processes workers added
+    since then.
+
+    """
+    def __init__(self, max_bytes=2**28):
+        """Initialize.
+
+        Args:
+            max_bytes (int):    Evict least recently used entries when
+                                entries take more memory than this.
+
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Copies (e.g. sent to pool processes) start empty.
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def _nbytes(entry):
+        lengths, ess = entry
+        return lengths.nbytes + sum(v.nbytes for v in ess)
+
+    def _put(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self.n_bytes -= self._nbytes(self._entries.pop(key))
+            self._entries[key] = entry
+            self.n_bytes += self._nbytes(entry)
+            while self.n_bytes > self.max_bytes and self._entries:
+                _, old = self._entries.popitem(last=False)
+                self.n_bytes -= self._nbytes(old)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put_ess(self, params, lengths, ess):
+        """Store E-step totals over workers.
+
+        Args:
+            params:         Model parameters.
+            lengths:        Steps taken with each worker (see
+                            History.pack()).
+            ess:            Output of model.forward_backward() for these
+                            workers.
+
+        """
+        self._put(get_params_version(params),
+                  (np.array(lengths, dtype=int),
+                   tuple(np.array(v, dtype=float) for v in ess)))
+
+    def get_ess(self, model, params, actions, observations, lengths):
+        """Return output of model.forward_backward(), reusing cached totals.
+
+        Totals stored with put_ess() are reused if their workers are the
+        first rows of the packed history, with the same number of steps, so
+        rows must refer to the same workers across calls (e.g. a history
+        that is only appended to). Only the remaining rows are run. Nothing
+        is stored, since callers rarely ask twice for the same parameters.
+
+        Args:
+            model (POMDPModel):     Model to run the E-step with.
+            params:                 Model parameters.
+            actions, observations, lengths: Packed history (see
+                                    History.pack()).
+
+        Returns:
+            ess_t, ess_o, ess_i, ll (totals over workers)
+
+        """
+        entry = self._get(get_params_version(params))
+        n_old = 0
+        if entry is not None:
+            lengths_old, ess = entry
+            n_old = len(lengths_old)
+            if not np.array_equal(lengths_old, lengths[:n_old]):
+                entry = None
+                n_old = 0
+        if entry is not None and n_old == len(lengths):
+            ess_t, ess_o, ess_i, ll = ess
+            return ess_t.copy(), ess_o.copy(), ess_i.copy(), float(ll)
+        ess_new = model.forward_backward(
+            params, actions[n_old:], observations[n_old:], lengths[n_old:])
+        if entry is not None:
+            ess_new = tuple(v + v_new for v, v_new in zip(ess, ess_new))
+        return ess_new
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
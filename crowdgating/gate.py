@@ -11,6 +11,7 @@ class Gate:
             n_tutorial=DEFAULT_GATING_PARAMS['n_tutorial'],
             n_screening=DEFAULT_GATING_PARAMS['n_screening'],
             exponential_backoff=DEFAULT_GATING_PARAMS['exponential_backoff'],
+            gold_schedule=DEFAULT_GATING_PARAMS['gold_schedule'],
             seed=None,
             test_policy=None,
     ):
@@ -21,25 +22,57 @@ class Gate:
         self.batch_size = batch_size
         self.gold_per_batch = gold_per_batch
         self.exponential_backoff = exponential_backoff
+        if gold_schedule not in gating.GOLD_SCHEDULES:
+            raise ValueError('Unknown gold schedule {}'.format(gold_schedule))
+        self.gold_schedule = gold_schedule
+        self.schedule = gating.GatingSchedule(
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
+            exponential_backoff=exponential_backoff,
+            gold_schedule=gold_schedule,
+        )
         self.seed = seed
         self.test_policy = test_policy
 
-    def next(self, history, seed=None):
-        tutorial = history.get('tutorial') or []
-        screening = history.get('screening') or []
-        work = history.get('work') or []
-        gating_recommendation = gating.next_action(
-            tutorial=tutorial,
-            screening=screening,
-            work=work,
+    def new_state(self):
+        """Return empty GateState, to update with each answer."""
+        return gating.GateState(n_gold_sliding=self.n_gold_sliding)
+
+    def get_state(self, history):
+        """Return GateState summarizing a history dictionary."""
+        return gating.GateState.from_history(
+            tutorial=history.get('tutorial'),
+            screening=history.get('screening'),
+            work=history.get('work'),
+            n_gold_sliding=self.n_gold_sliding,
+        )
+
+    def next(self, history, seed=None, worker_id=None):
+        """Return next action for a worker.
+
+        Args:
+            history: Dictionary with 'tutorial', 'screening', and 'work'
+                answers, or a gating.GateState kept up to date with them
+                (see new_state()), which avoids rescanning the history.
+
+        """
+        if isinstance(history, gating.GateState):
+            state = history
+            work = None
+        else:
+            state = self.get_state(history)
+            work = history.get('work') or []
+        gating_recommendation = gating.next_action_state(
+            state=state,
             n_tutorial=self.n_tutorial,
             n_screening=self.n_screening,
             desired_accuracy=self.desired_accuracy,
-            n_gold_sliding=self.n_gold_sliding,
             batch_size=self.batch_size,
             gold_per_batch=self.gold_per_batch,
             exponential_backoff=self.exponential_backoff,
             seed=seed if seed is None else self.seed,
+            gold_schedule=self.gold_schedule,
+            schedule=self.schedule,
         )
         if self.test_policy:
             raise NotImplementedError
@@ -48,8 +81,7 @@ class Gate:
                 or gating_recommendation and (
                     'tutorial' in gating_recommendation
                     or 'screening' in gating_recommendation
-                ) or not gating._passes_screening(
-                    screening=screening,
+                ) or not state.passes_screening(
                     accuracy=self.desired_accuracy,
                 )
         ):
@@ -60,4 +92,85 @@ class Gate:
             desired_accuracy=self.desired_accuracy,
             work_history=work,
             resolve=True,  # TODO: Don't always resolve.
+            worker_id=worker_id,
+        )
+
+    def plan(self, history, k, seed=None):
+        """Return next k actions for a worker, as repeated next() calls would
+        if every tutorial, screening, and gold question is answered right.
+
+        Gold is placed with the Gate's seed, as next() does when given a
+        seed, so plans are deterministic and next() follows them.
+
+        Args:
+            history:    History dictionary or GateState.
+            k (int):    Number of actions to plan.
+            seed (int): Seed to use if the Gate has none.
+
+        Returns:
+            actions:        List of up to k actions, in the format returned
+                            by next(), ending early if the worker is removed.
+            checkpoints:    Indices into actions of questions whose wrong
+                            answer may invalidate the rest of the plan (see
+                            gating.plan_state()).
+
+        Raises:
+            ValueError: If neither the Gate nor the call gives a seed.
+
+        """
+        if self.test_policy:
+            raise NotImplementedError
+        if self.seed is not None:
+            seed = self.seed
+        if seed is None:
+            raise ValueError('Planning requires a seed')
+        if not isinstance(history, gating.GateState):
+            history = self.get_state(history)
+        return gating.plan_state(
+            state=history,
+            k=k,
+            n_tutorial=self.n_tutorial,
+            n_screening=self.n_screening,
+            desired_accuracy=self.desired_accuracy,
+            batch_size=self.batch_size,
+            gold_per_batch=self.gold_per_batch,
+            exponential_backoff=self.exponential_backoff,
+            seed=seed,
+            gold_schedule=self.gold_schedule,
+            schedule=self.schedule,
+        )
+
+    def next_many(self, histories, seed=None):
+        """Return next actions for many workers, as next() would.
+
+        Decisions are computed with vectorized operations over all workers
+        (see gating.next_actions()).
+
+        Args:
+            histories:  List of history dictionaries or GateState.
+
+        Returns:
+            List of actions, in the format returned by next().
+
+        """
+        if self.test_policy:
+            raise NotImplementedError
+        states = [
+            h if isinstance(h, gating.GateState) else self.get_state(h)
+            for h in histories
+        ]
+        actions, indices = gating.next_actions(
+            n_tutorial=self.n_tutorial,
+            n_screening=self.n_screening,
+            desired_accuracy=self.desired_accuracy,
+            n_gold_sliding=self.n_gold_sliding,
+            batch_size=self.batch_size,
+            gold_per_batch=self.gold_per_batch,
+            exponential_backoff=self.exponential_backoff,
+            seed=seed if seed is None else self.seed,
+            gold_schedule=self.gold_schedule,
+            schedule=self.schedule,
+            **gating.state_columns(states)
         )
+        return [gating.action_dict(a, i)
+                for a, i in zip(actions.tolist(), indices.tolist())]
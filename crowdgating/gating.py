@@ -1,11 +1,13 @@
 from __future__ import division
+import collections
+import functools
 import math
 import random
 import doctest
+import numpy as np
 
-
-def _is_power_two(n):
-    return math.ceil(math.log(n, 2)) == math.floor(math.log(n, 2))
+# Action codes returned by next_actions().
+TUTORIAL, SCREENING, TEST, WORK, BOOT = range(5)
 
 
 def next_tutorial_action(tutorial, size):
@@ -54,80 +56,566 @@ def _passes_gold(work, n_gold_sliding, accuracy):
     return len(tests) < n_gold_sliding or sum(tests) >= min_right
 
 
-def _is_test_batch(batch_index, exponential_backoff):
-    if not exponential_backoff:
-        return True
-    return _is_power_two(batch_index + 1)
+class GateState(object):
+    """Running summary of a worker's answers, enough for gating decisions.
+
+    Each answer updates the state in O(1): tutorial position, screening
+    counts, the last n_gold_sliding gold outcomes with their sum, and the
+    number of work answers.
+
+    >>> state = GateState.from_history([1, 1], [1, 0], [None, 1, None, 0], 2)
+    >>> state.passes_screening(0.5), state.passes_gold(0.8), state.n_work
+    (True, False, 4)
+    >>> state.add_work(1)
+    >>> state.add_work(1)
+    >>> state.passes_gold(0.8)
+    True
+
+    """
+    def __init__(self, n_gold_sliding):
+        self.n_tutorial = 0
+        self.tutorial_last = None
+        self.n_screening = 0
+        self.n_screening_right = 0
+        self.n_work = 0
+        self.n_gold_sliding = n_gold_sliding
+        self.gold = collections.deque(maxlen=n_gold_sliding)
+        self.n_gold_right = 0
+
+    @classmethod
+    def from_history(cls, tutorial, screening, work, n_gold_sliding):
+        state = cls(n_gold_sliding)
+        for answer in tutorial or []:
+            state.add_tutorial(answer)
+        for answer in screening or []:
+            state.add_screening(answer)
+        for answer in work or []:
+            state.add_work(answer)
+        return state
+
+    def copy(self):
+        state = GateState(self.n_gold_sliding)
+        state.__dict__.update(self.__dict__)
+        state.gold = collections.deque(self.gold, maxlen=self.n_gold_sliding)
+        return state
+
+    def add_tutorial(self, answer):
+        self.n_tutorial += 1
+        self.tutorial_last = answer
+
+    def add_screening(self, answer):
+        self.n_screening += 1
+        self.n_screening_right += answer
+
+    def add_work(self, answer):
+        """Add work answer: None if not gold, else whether it was right."""
+        self.n_work += 1
+        if answer is not None and self.n_gold_sliding > 0:
+            if len(self.gold) == self.n_gold_sliding:
+                self.n_gold_right -= self.gold[0]
+            self.gold.append(answer)
+            self.n_gold_right += answer
+
+    def next_tutorial_action(self, size):
+        if self.n_tutorial and not self.tutorial_last:
+            return self.n_tutorial - 1
+        elif self.n_tutorial < size:
+            return self.n_tutorial
+        return -1
+
+    def next_screening_action(self, size):
+        if self.n_screening >= size:
+            return None
+        return self.n_screening
+
+    def passes_screening(self, accuracy):
+        return (not self.n_screening or
+                self.n_screening_right / self.n_screening >= accuracy)
+
+    def passes_gold(self, accuracy):
+        min_right = math.ceil(accuracy * self.n_gold_sliding)
+        return (len(self.gold) < self.n_gold_sliding or
+                self.n_gold_right >= min_right)
+
+
+GOLD_SCHEDULES = ('shuffle', 'sample')
+
+
+def _gold_positions_seeded(batch_index, batch_size, gold_per_batch, seed,
+                           gold_schedule):
+    if gold_schedule == 'shuffle':
+        gold = [True if i < gold_per_batch else False
+                for i in range(batch_size)]
+        random.Random(seed + batch_index).shuffle(gold)
+        return frozenset(i for i, x in enumerate(gold) if x)
+    elif gold_schedule == 'sample':
+        rng = random.Random('{}:{}'.format(seed, batch_index))
+        return frozenset(rng.sample(range(batch_size),
+                                    min(gold_per_batch, batch_size)))
+    raise ValueError('Unknown gold schedule {}'.format(gold_schedule))
+
+
+_gold_positions_cached = functools.lru_cache(maxsize=1024)(
+    _gold_positions_seeded)
+
+
+def gold_positions(batch_index, batch_size, gold_per_batch, seed=None,
+                   gold_schedule='shuffle'):
+    """Return positions of gold questions within a batch.
+
+    Uses a private random number generator, so global random state is
+    left untouched. Results for a given seed are cached, so deciding each
+    item of a batch costs O(1) after the first. Unseeded results are not
+    cached, since they are never reused.
+
+    Args:
+        batch_index (int):      Index of batch.
+        batch_size (int):       Number of work questions in a batch.
+        gold_per_batch (int):   Number of gold questions in a batch.
+        seed (int):             Seed for the worker. If None, positions are
+                                drawn fresh on every call.
+        gold_schedule (str):    'shuffle' reproduces shuffling the batch
+                                with random.seed(seed + batch_index), as
+                                earlier versions did. 'sample' draws
+                                gold_per_batch positions in
+                                O(gold_per_batch), keyed by seed and
+                                batch_index.
+
+    Returns:
+        frozenset of positions in range(batch_size).
+
+    >>> sorted(gold_positions(0, 20, 5, seed=0))
+    [4, 7, 8, 12, 17]
+    >>> len(gold_positions(3, 1000, 2, seed=0, gold_schedule='sample'))
+    2
+
+    """
+    if seed is None:
+        return _gold_positions_seeded(
+            batch_index, batch_size, gold_per_batch,
+            random.SystemRandom().getrandbits(64), gold_schedule)
+    return _gold_positions_cached(
+        batch_index, batch_size, gold_per_batch, seed, gold_schedule)
+
+
+class GatingSchedule(object):
+    """Placement of gold questions among work questions.
+
+    Built once per gating configuration. Answers questions about work
+    index k (the number of work answers before it) with integer
+    arithmetic, so callers can look ahead without simulating decisions
+    step by step. Answers are deterministic only for a given seed (see
+    gold_positions()).
+
+    >>> schedule = GatingSchedule(batch_size=4, gold_per_batch=1,
+    ...                           exponential_backoff=True)
+    >>> [b for b in range(10) if schedule.is_test_batch(b)]
+    [0, 1, 3, 7]
+    >>> schedule.is_test_batch(2**60 - 1), schedule.is_test_batch(2**60)
+    (True, False)
+    >>> schedule.n_gold_before(16, seed=0)
+    3
+    >>> k = schedule.next_gold(8, seed=0)
+    >>> k // 4, schedule.is_gold(k, seed=0)
+    (3, True)
+
+    """
+    def __init__(self, batch_size, gold_per_batch, exponential_backoff,
+                 gold_schedule='shuffle'):
+        self.batch_size = batch_size
+        self.gold_per_batch = min(gold_per_batch, batch_size)
+        self.exponential_backoff = exponential_backoff
+        self.gold_schedule = gold_schedule
+
+    def is_test_batch(self, batch_index):
+        """Return whether batch has gold (works on int or NumPy arrays)."""
+        if not self.exponential_backoff:
+            return np.ones_like(batch_index, dtype=bool) \
+                if isinstance(batch_index, np.ndarray) else True
+        # batch_index + 1 is a power of two.
+        return ((batch_index + 1) & batch_index) == 0
+
+    def n_test_batches(self, n_batches):
+        """Return number of test batches among the first n_batches."""
+        if not self.exponential_backoff:
+            return n_batches
+        return n_batches.bit_length()
+
+    def next_test_batch(self, batch_index):
+        """Return index of first test batch after batch_index."""
+        if not self.exponential_backoff:
+            return batch_index + 1
+        return (1 << (batch_index + 1).bit_length()) - 1
+
+    def gold_positions(self, batch_index, seed=None):
+        """Return frozenset of gold positions within batch."""
+        if not self.is_test_batch(batch_index):
+            return frozenset()
+        return gold_positions(
+            batch_index=batch_index,
+            batch_size=self.batch_size,
+            gold_per_batch=self.gold_per_batch,
+            seed=seed,
+            gold_schedule=self.gold_schedule,
+        )
+
+    def is_gold(self, k, seed=None):
+        """Return whether work index k is a gold question."""
+        batch_index, position = divmod(k, self.batch_size)
+        return position in self.gold_positions(batch_index, seed=seed)
+
+    def n_gold_before(self, k, seed=None):
+        """Return number of gold questions before work index k."""
+        batch_index, position = divmod(k, self.batch_size)
+        n = self.n_test_batches(batch_index) * self.gold_per_batch
+        if position:
+            n += sum(1 for p in self.gold_positions(batch_index, seed=seed)
+                     if p < position)
+        return n
+
+    def next_gold(self, k, seed=None):
+        """Return first work index at or after k that is gold.
+
+        Returns None if there are no gold questions.
+
+        """
+        if not self.gold_per_batch:
+            return None
+        batch_index, position = divmod(k, self.batch_size)
+        later = [p for p in self.gold_positions(batch_index, seed=seed)
+                 if p >= position]
+        if later:
+            return batch_index * self.batch_size + min(later)
+        batch_index = self.next_test_batch(batch_index)
+        return batch_index * self.batch_size + min(
+            self.gold_positions(batch_index, seed=seed))
 
 
 def should_test(
         screening, work, desired_accuracy, n_gold_sliding, batch_size,
         gold_per_batch, exponential_backoff, seed=None,
+        gold_schedule='shuffle',
+):
+    return should_test_state(
+        state=GateState.from_history(
+            tutorial=None,
+            screening=screening,
+            work=work,
+            n_gold_sliding=n_gold_sliding,
+        ),
+        desired_accuracy=desired_accuracy,
+        batch_size=batch_size,
+        gold_per_batch=gold_per_batch,
+        exponential_backoff=exponential_backoff,
+        seed=seed,
+        gold_schedule=gold_schedule,
+    )
+
+
+def should_test_state(
+        state, desired_accuracy, batch_size, gold_per_batch,
+        exponential_backoff, seed=None, gold_schedule='shuffle',
+        schedule=None,
 ):
     if (
-            not _passes_screening(
-                screening=screening,
-                accuracy=desired_accuracy,
-            )
-            or not _passes_gold(
-                work=work,
-                n_gold_sliding=n_gold_sliding,
-                accuracy=desired_accuracy,
-            )
+            not state.passes_screening(accuracy=desired_accuracy)
+            or not state.passes_gold(accuracy=desired_accuracy)
     ):
         return None
-    batch_index = int(len(work) / batch_size)
-
-    test_batch = True
-    if exponential_backoff:
-        test_batch = _is_test_batch(
-            batch_index=batch_index,
+    if schedule is None:
+        schedule = GatingSchedule(
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
             exponential_backoff=exponential_backoff,
+            gold_schedule=gold_schedule,
         )
-
-    if not test_batch:
-        return False
-
-    gold = [True if i < gold_per_batch else False for i in range(batch_size)]
-    if seed is not None:
-        seed += batch_index
-    random.seed(seed)
-    random.shuffle(gold)
-
-    n_current_batch = len(work) % batch_size
-    return gold[n_current_batch]
+    return schedule.is_gold(state.n_work, seed=seed)
 
 
 def next_action(
         tutorial, screening, work, n_tutorial, n_screening, desired_accuracy,
         n_gold_sliding, batch_size, gold_per_batch, exponential_backoff,
-        seed=None,
+        seed=None, gold_schedule='shuffle',
 ):
-    tutorial_action = next_tutorial_action(
-        tutorial=tutorial or [],
-        size=n_tutorial,
+    return next_action_state(
+        state=GateState.from_history(
+            tutorial=tutorial,
+            screening=screening,
+            work=work,
+            n_gold_sliding=n_gold_sliding,
+        ),
+        n_tutorial=n_tutorial,
+        n_screening=n_screening,
+        desired_accuracy=desired_accuracy,
+        batch_size=batch_size,
+        gold_per_batch=gold_per_batch,
+        exponential_backoff=exponential_backoff,
+        seed=seed,
+        gold_schedule=gold_schedule,
     )
+
+
+def next_action_state(
+        state, n_tutorial, n_screening, desired_accuracy, batch_size,
+        gold_per_batch, exponential_backoff, seed=None,
+        gold_schedule='shuffle', schedule=None,
+):
+    tutorial_action = state.next_tutorial_action(size=n_tutorial)
     if tutorial_action >= 0:
         return {'tutorial': tutorial_action}
-    screening_action = next_screening_action(
-        screening=screening or [],
-        size=n_screening,
-    )
+    screening_action = state.next_screening_action(size=n_screening)
     if screening_action is not None:
         return {'screening': screening_action}
-    is_test_work_action = should_test(
-        screening=screening or [],
-        work=work or [],
+    is_test_work_action = should_test_state(
+        state=state,
         desired_accuracy=desired_accuracy,
-        n_gold_sliding=n_gold_sliding,
         batch_size=batch_size,
         gold_per_batch=gold_per_batch,
         exponential_backoff=exponential_backoff,
         seed=seed,
+        gold_schedule=gold_schedule,
+        schedule=schedule,
     )
     if is_test_work_action is not None:
         return {'test': is_test_work_action}
     return None
 
+
+def plan_state(
+        state, k, n_tutorial, n_screening, desired_accuracy, batch_size,
+        gold_per_batch, exponential_backoff, seed=None,
+        gold_schedule='shuffle', schedule=None,
+):
+    """Return next k actions, assuming every tutorial, screening, and gold
+    question is answered right.
+
+    Args:
+        state (GateState):  Current state (not modified).
+        k (int):            Number of actions to plan.
+
+    Returns:
+        actions:        List of up to k actions, in the format of
+                        next_action_state(). Shorter if the worker is
+                        removed (None is never included).
+        checkpoints:    Indices into actions of questions whose wrong
+                        answer may change the plan after them: tutorial
+                        questions (which are repeated), and screening and
+                        gold questions whose wrong answers, alone or with
+                        others, could lead to removal. The plan holds only
+                        while every checkpoint is answered right; plan
+                        again from the updated state after any wrong one.
+
+    >>> actions, checkpoints = plan_state(
+    ...     GateState.from_history([1], [], [], 2), 4, n_tutorial=2,
+    ...     n_screening=2, desired_accuracy=0.8, batch_size=20,
+    ...     gold_per_batch=0, exponential_backoff=True, seed=0)
+    >>> actions
+    [{'tutorial': 1}, {'screening': 0}, {'screening': 1}, {'test': False}]
+    >>> checkpoints
+    [0, 1, 2]
+
+    """
+    if schedule is None:
+        schedule = GatingSchedule(
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
+            exponential_backoff=exponential_backoff,
+            gold_schedule=gold_schedule,
+        )
+    # Screening cannot be failed if it would pass with all remaining
+    # questions wrong, and gold cannot if the window tolerates all wrong.
+    screening_safe = (
+        state.n_screening_right / max(n_screening, 1) >= desired_accuracy)
+    n_gold_sliding = state.n_gold_sliding
+    gold_safe = math.ceil(desired_accuracy * n_gold_sliding) <= 0
+    state = state.copy()
+    actions = []
+    checkpoints = []
+    for i in range(k):
+        action = next_action_state(
+            state=state,
+            n_tutorial=n_tutorial,
+            n_screening=n_screening,
+            desired_accuracy=desired_accuracy,
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
+            exponential_backoff=exponential_backoff,
+            seed=seed,
+            schedule=schedule,
+        )
+        if action is None:
+            break
+        actions.append(action)
+        if 'tutorial' in action:
+            checkpoints.append(i)
+            state.add_tutorial(True)
+        elif 'screening' in action:
+            if not screening_safe:
+                checkpoints.append(i)
+            state.add_screening(True)
+        elif action['test']:
+            if not gold_safe:
+                checkpoints.append(i)
+            state.add_work(True)
+        else:
+            state.add_work(None)
+    return actions, checkpoints
+
+
+def state_columns(states):
+    """Return dictionary of count columns for next_actions().
+
+    Args:
+        states: Iterable of GateState.
+
+    """
+    states = list(states)
+    columns = {
+        'n_tutorial_done': [s.n_tutorial for s in states],
+        'tutorial_last': [bool(s.tutorial_last) for s in states],
+        'n_screening_done': [s.n_screening for s in states],
+        'n_screening_right': [s.n_screening_right for s in states],
+        'n_work': [s.n_work for s in states],
+        'n_gold': [len(s.gold) for s in states],
+        'n_gold_right': [s.n_gold_right for s in states],
+    }
+    return dict((k, np.array(v, dtype=int if k != 'tutorial_last' else bool))
+                for k, v in columns.items())
+
+
+def _gold_mask(batch_index, position, batch_size, gold_per_batch, seed,
+               gold_schedule):
+    """Return whether each position is gold, one schedule per unique key."""
+    if seed is None:
+        return np.array([
+            p in gold_positions(
+                batch_index=b,
+                batch_size=batch_size,
+                gold_per_batch=gold_per_batch,
+                gold_schedule=gold_schedule,
+            ) for b, p in zip(batch_index.tolist(), position.tolist())
+        ], dtype=bool)
+    seed = np.broadcast_to(np.asarray(seed, dtype=np.int64), batch_index.shape)
+    keys, inverse = np.unique(
+        np.stack([batch_index, seed], axis=1), axis=0, return_inverse=True)
+    table = np.zeros((len(keys), batch_size), dtype=bool)
+    for i, (b, s) in enumerate(keys.tolist()):
+        table[i, list(gold_positions(
+            batch_index=b,
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
+            seed=s,
+            gold_schedule=gold_schedule,
+        ))] = True
+    return table[inverse.ravel(), position]
+
+
+def next_actions(
+        n_tutorial_done, tutorial_last, n_screening_done, n_screening_right,
+        n_work, n_gold, n_gold_right, n_tutorial, n_screening,
+        desired_accuracy, n_gold_sliding, batch_size, gold_per_batch,
+        exponential_backoff, seed=None, gold_schedule='shuffle',
+        schedule=None,
+):
+    """Return next actions for many workers at once.
+
+    Column-oriented counterpart of next_action_state(), with one entry per
+    worker in each array argument (see state_columns()).
+
+    Args:
+        n_tutorial_done:    Number of tutorial answers.
+        tutorial_last:      Whether last tutorial answer was right.
+        n_screening_done:   Number of screening answers.
+        n_screening_right:  Number of right screening answers.
+        n_work:             Number of work answers.
+        n_gold:             Number of gold answers in the sliding window.
+        n_gold_right:       Number of right gold answers in the window.
+        seed:               Seed (int, or array with one per worker). If
+                            None, gold positions are drawn fresh.
+
+    Returns:
+        actions:    Array of action codes (TUTORIAL, SCREENING, TEST, WORK,
+                    or BOOT).
+        indices:    Array with question index for TUTORIAL and SCREENING
+                    actions, and -1 otherwise.
+
+    >>> actions, indices = next_actions(
+    ...     n_tutorial_done=[1, 2, 2, 2], tutorial_last=[0, 1, 1, 1],
+    ...     n_screening_done=[0, 1, 2, 2], n_screening_right=[0, 1, 0, 2],
+    ...     n_work=[0, 0, 0, 0], n_gold=[0, 0, 0, 0], n_gold_right=[0, 0, 0, 0],
+    ...     n_tutorial=2, n_screening=2, desired_accuracy=0.8,
+    ...     n_gold_sliding=10, batch_size=20, gold_per_batch=5,
+    ...     exponential_backoff=True, seed=0)
+    >>> actions.tolist(), indices.tolist()
+    ([0, 1, 4, 3], [0, 1, -1, -1])
+
+    """
+    n_tutorial_done = np.asarray(n_tutorial_done, dtype=int)
+    tutorial_last = np.asarray(tutorial_last, dtype=bool)
+    n_screening_done = np.asarray(n_screening_done, dtype=int)
+    n_screening_right = np.asarray(n_screening_right, dtype=int)
+    n_work = np.asarray(n_work, dtype=int)
+    n_gold = np.asarray(n_gold, dtype=int)
+    n_gold_right = np.asarray(n_gold_right, dtype=int)
+
+    actions = np.full(n_work.shape, BOOT, dtype=int)
+    indices = np.full(n_work.shape, -1, dtype=int)
+
+    # Gating on screening and sliding window of gold.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        passes = (n_screening_done == 0) | (
+            n_screening_right / n_screening_done >= desired_accuracy)
+    min_right = math.ceil(desired_accuracy * n_gold_sliding)
+    passes &= (n_gold < n_gold_sliding) | (n_gold_right >= min_right)
+
+    # Work (no gold when not in a test batch).
+    batch_index = n_work // batch_size
+    position = n_work % batch_size
+    if schedule is None:
+        schedule = GatingSchedule(
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
+            exponential_backoff=exponential_backoff,
+            gold_schedule=gold_schedule,
+        )
+    test_batch = passes & schedule.is_test_batch(batch_index)
+    actions[passes] = WORK
+    if test_batch.any():
+        gold = _gold_mask(
+            batch_index=batch_index[test_batch],
+            position=position[test_batch],
+            batch_size=batch_size,
+            gold_per_batch=gold_per_batch,
+            seed=(seed if seed is None or np.ndim(seed) == 0
+                  else np.asarray(seed)[test_batch]),
+            gold_schedule=gold_schedule,
+        )
+        actions[np.flatnonzero(test_batch)[gold]] = TEST
+
+    # Screening and tutorial take precedence.
+    screening = n_screening_done < n_screening
+    actions[screening] = SCREENING
+    indices[screening] = n_screening_done[screening]
+    retry = (n_tutorial_done > 0) & ~tutorial_last
+    tutorial = retry | (n_tutorial_done < n_tutorial)
+    actions[tutorial] = TUTORIAL
+    indices[tutorial] = np.where(
+        retry, n_tutorial_done - 1, n_tutorial_done)[tutorial]
+    return actions, indices
+
+
+def action_dict(action, index):
+    """Return next_action() result for code and index from next_actions()."""
+    if action == TUTORIAL:
+        return {'tutorial': index}
+    elif action == SCREENING:
+        return {'screening': index}
+    elif action == TEST:
+        return {'test': True}
+    elif action == WORK:
+        return {'test': False}
+    return None
+
+
 if __name__ == "__main__":
     doctest.testmod()
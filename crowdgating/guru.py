@@ -1,9 +1,35 @@
+import hashlib
+import json
 import os
+import threading
 from . import constants
 from . import param
 from . import util
 from .policy import Policy
 from .history import History
+from .belief_cache import BeliefCache
+from .policy_cache import PolicyCache
+from .scheduler import SolveScheduler
+
+# Beliefs of workers seen by this process, keyed by (policy key, worker id).
+BELIEF_CACHE = BeliefCache()
+
+# Ready policies, keyed by (desired accuracy, config digest).
+_POLICIES = dict()
+_POLICIES_LOCK = threading.Lock()
+
+# First solves block the requests waiting for them, so they get their own
+# pool and never queue behind background resolves. Resolves are CPU-bound
+# and not urgent, so they run one at a time.
+SOLVE_SCHEDULER = SolveScheduler(max_workers=os.cpu_count() or 1)
+RESOLVE_SCHEDULER = SolveScheduler(max_workers=1)
+
+# Solved policies, shared by all processes using this package.
+POLICY_CACHE_MAX_BYTES = 2 ** 30
+POLICY_CACHE = PolicyCache(
+    path=os.path.join(os.path.dirname(__file__), 'policies', 'cache'),
+    max_bytes=POLICY_CACHE_MAX_BYTES,
+)
 
 def get_config(desired_accuracy):
     # TODO: Make this more configurable.
@@ -19,9 +45,91 @@ def get_config(desired_accuracy):
     return config
 
 
-def get_action(desired_accuracy, work_history, resolve=False):
-    """Get action from policy."""
+def get_config_key(config):
+    """Return digest identifying a config."""
+    return hashlib.sha1(
+        json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _make_policy(config):
+    """Return new Policy for config, with model tables precomputed."""
+    params = param.Params.from_cmd(config)
+    pol = Policy(
+        policy_type='zmdp',
+        n_worker_classes=params.n_classes,
+        params_gt=params.get_param_dict(sample=False),
+        discount=config['zmdp_discount'],
+        timeout=config['zmdp_timeout'],
+    )
+    pol.model.get_tables()
+    pol.model.get_reward_table()
+    return pol
+
+
+def _solve(pol):
+    """Solve policy through the policy cache and swap in the result.
+
+    Policy.prep_worker() assigns the new POMDPPolicy only once it is fully
+    loaded, so requests served during the solve keep using the last good
+    policy.
+
+    """
+    pol.prep_worker(
+        model_filepath=None,
+        policy_filepath=None,
+        history=History(),
+        resolve_p=True,
+        policy_cache=POLICY_CACHE,
+    )
+
+
+def get_policy(desired_accuracy, resolve=False, wait=False):
+    """Return registry key and ready Policy for desired accuracy.
+
+    Policies are built, solved, and loaded once per process and reused
+    by later calls with the same accuracy and config. Resolves run in the
+    background, deduplicated per key, while the last good policy keeps
+    serving. Only the first solve for a key blocks.
+
+    Args:
+        desired_accuracy (float):   Desired accuracy.
+        resolve (bool):             Schedule a resolve even if already
+                                    solved.
+        wait (bool):                Wait for a scheduled resolve to finish.
+
+    Returns:
+        (key, Policy)
+
+    """
     config = get_config(desired_accuracy)
+    key = (desired_accuracy, get_config_key(config))
+    with _POLICIES_LOCK:
+        pol = _POLICIES.get(key)
+        if pol is None:
+            pol = _make_policy(config)
+            _POLICIES[key] = pol
+    if pol.external_policy is None:
+        SOLVE_SCHEDULER.submit(key, _solve, pol).result()
+    elif resolve:
+        future = RESOLVE_SCHEDULER.submit(key, _solve, pol)
+        if wait:
+            future.result()
+    return key, pol
+
+
+def get_action(desired_accuracy, work_history, resolve=False, worker_id=None):
+    """Get action from policy.
+
+    Args:
+        desired_accuracy (float):   Desired accuracy.
+        work_history (list):        Work history (None, True, or False).
+        resolve (bool):             Schedule a background resolve.
+        worker_id:                  Optional worker id. If given, the
+                                    worker's belief is cached, and later
+                                    calls extend it with only new answers.
+
+    """
+    key, pol = get_policy(desired_accuracy, resolve=resolve)
 
     # Convert history.
     history = History()
@@ -43,36 +151,14 @@ def get_action(desired_accuracy, work_history, resolve=False):
                 observation=constants.O_RIGHT,
             )
 
-    params = param.Params.from_cmd(config)
-
-    pol = Policy(
-        policy_type='zmdp',
-        n_worker_classes=params.n_classes,
-        params_gt=params.get_param_dict(sample=False),
-    )
-    pomdp_dirpath = os.path.join(
-        os.path.dirname(__file__), 'models',
-    )
-    policy_dirpath = os.path.join(
-        os.path.dirname(__file__), 'policies',
-    )
-    for d in [pomdp_dirpath, policy_dirpath]:
-        util.ensure_dir(d)
-    pomdp_fpath = os.path.join(
-        pomdp_dirpath, 'sample.pomdp',
-    )
-    policy_fpath = os.path.join(
-        policy_dirpath, 'sample.policy',
-    )
-    pol.prep_worker(
-        model_filepath=pomdp_fpath,
-        policy_filepath=policy_fpath,
-        history=history,
-        resolve_p=resolve,
-    )
-    belief = pol.model.get_start_belief()
-    for a, o, _ in history.history[-1]:
-        pol.model.update_belief(belief, a, o)
+    if worker_id is None:
+        belief = pol.model.get_beliefs(history)[-1]
+    else:
+        belief = BELIEF_CACHE.get_belief(
+            model=pol.model,
+            key=(key, worker_id),
+            steps=history.history[-1],
+        )
     a = pol.get_best_action(
         history=history,
         belief=belief,
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class History:
     def __init__(self):
         self.history = []
@@ -16,3 +19,30 @@ class History:
     def n_t(self, worker):
         """Return number of actions taken with worker"""
         return len(self.history[worker])
+
+    def pack(self, workers=None):
+        """Return history as padded arrays, one row per worker.
+
+        Args:
+            workers:    Indices of workers to include. Defaults to all.
+
+        Returns:
+            actions (|W|.|Tmax| int array):         Padded with 0.
+            observations (|W|.|Tmax| int array):    Padded with 0.
+            lengths (|W| int array):                Steps taken with each
+                                                    worker.
+
+        """
+        if workers is None:
+            workers = range(len(self.history))
+        history = [self.history[w] for w in workers]
+        lengths = np.array([len(w) for w in history], dtype=int)
+        shape = (len(lengths), lengths.max() if len(lengths) else 0)
+        actions = np.zeros(shape, dtype=int)
+        observations = np.zeros(shape, dtype=int)
+        for worker, worker_AO in enumerate(history):
+            if worker_AO:
+                ao = np.array([x[:2] for x in worker_AO], dtype=int)
+                actions[worker, :len(ao)] = ao[:, 0]
+                observations[worker, :len(ao)] = ao[:, 1]
+        return actions, observations, lengths
@@ -37,6 +37,11 @@ if __name__ == '__main__':
         '--no_exponential_backoff', action='store_true',
         help='Do not use exponential backoff in gating',
     )
+    parser.add_argument(
+        '--gold_schedule', choices=['shuffle', 'sample'],
+        default=constants.DEFAULT_GATING_PARAMS['gold_schedule'],
+        help='How gold questions are placed within a batch',
+    )
 
     parser.add_argument(
         '--seed', '-s', type=int,
@@ -69,6 +74,7 @@ if __name__ == '__main__':
         batch_size=args.batch_size,
         gold_per_batch=args.gold_per_batch,
         exponential_backoff=not args.no_exponential_backoff,
+        gold_schedule=args.gold_schedule,
         n_tutorial=args.n_tutorial,
         n_screening=args.n_screening,
         seed=args.seed,
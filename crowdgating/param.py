@@ -190,7 +190,7 @@ class Params(object):
                   self.get_param_type(param) == param_type]
         for param in params:
             key, cls = param
-            for worker in xrange(self.n_classes):
+            for worker in range(self.n_classes):
                 self.params[key, worker] = self.params[param]
             if cls is None:
                 del self.params[param]
@@ -226,7 +226,7 @@ class HyperParams(object):
                 # Make peaked dirichlet at parameters.
                 p[k] = [1.00001 + PEAKEDNESS * v for v in params[k]]
             elif t == 'p_worker':
-                p[k] = [1.00001 for i in xrange(n_worker_classes)]
+                p[k] = [1.00001 for i in range(n_worker_classes)]
             #elif t == 'p_guess':
             #    p[k] = [10, 10] # Pretty sure this is 0.5.
             elif t == 'p_slip':
@@ -373,7 +373,7 @@ class HyperParamsSpacedStronger(HyperParamsSpaced):
         for k in self.p:
             t = Params.get_param_type(k)
             if t == 'p_worker':
-                self.p[k] = [WEAK_PRIOR_MAG for i in xrange(n_worker_classes)]
+                self.p[k] = [WEAK_PRIOR_MAG for i in range(n_worker_classes)]
 
 class HyperParamsSpacedStrongerUnknownRatio(HyperParamsSpacedStronger):
     """Hyperparameters with known class properties but unknown ratio."""
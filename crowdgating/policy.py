@@ -14,6 +14,7 @@ import math
 import subprocess
 import numpy as np
 from .pomdp import POMDPPolicy, POMDPModel
+from .ess_cache import ESSCache
 from . import util
 from .util import ensure_dir
 from . import work_learn_problem as wlp
@@ -21,6 +22,9 @@ from . import param
 
 ZMDP_ALIAS = os.environ.get('ZMDP_ALIAS', 'pomdpsol-zmdp')
 
+# Policy types computed by an external POMDP solver.
+SOLVER_POLICY_TYPES = ('appl', 'aitoolbox', 'zmdp')
+
 class Policy:
     """Policy class
 
@@ -45,7 +49,9 @@ class Policy:
             self.model = POMDPModel(
                 n_worker_classes, params=params_gt,
                 hyperparams=cls(params_gt, n_worker_classes),
-                estimate_all=True)
+                estimate_all=True,
+                ess_cache=ESSCache(
+                    max_bytes=kwargs.get('ess_cache_bytes', 2**28)))
             if self.explore_policy is not None:
                 self.explore_policy = Policy(
                     policy_type=self.explore_policy['type'],
@@ -112,10 +118,15 @@ class Policy:
     def prep_worker(self, model_filepath, policy_filepath, history,
                     resolve_p=False,
                     resolve_random_restarts=1,
-                    previous_workers=None, explore=None):
+                    previous_workers=None, explore=None,
+                    policy_cache=None, online=False, posterior_only=False):
         """Reestimate and resolve as needed.
 
         Args:
+            model_filepath (str): Path for input to POMDP solver. Unused
+                if policy_cache is given.
+            policy_filepath (str): Path for computed policy. Unused if
+                policy_cache is given.
             history (.history.History): History of workers.
                 IMPORTANT: Do not call .history.History.new_worker() before
                 running this function or the worker count will be incorrect.
@@ -124,28 +135,48 @@ class Policy:
                 when re-estimating model.
             previous_workers (Optional[int]): Number of previous workers.
                 Defaults to one less than number of workers in history object.
+            policy_cache (Optional[.policy_cache.PolicyCache]): Solve
+                through this cache of solved policies.
+            online (bool): Re-estimate with online EM, using only the
+                workers added since the last estimate, instead of running
+                EM on the full history.
+            posterior_only (bool): For Thompson sampling, only add the
+                workers added since the last estimate to the posterior
+                before sampling, instead of re-estimating.
 
         """
         t = 0
         self.use_explore_policy = False
+        if previous_workers is None:
+            previous_workers = history.n_workers() - 1
+        worker = previous_workers
 
         estimate_p = self.rl_p() and resolve_p
         model = self.model
         if estimate_p:
-            start = time.clock()
-            model.estimate(history=history,
-                           last_params=(len(self.params_estimated) > 0),
-                           random_restarts=resolve_random_restarts)
+            start = time.process_time()
+            if self.thompson and posterior_only:
+                model.update_posterior(history=history)
+            elif online:
+                model.estimate_online(history=history)
+            else:
+                model.estimate(history=history,
+                               last_params=(len(self.params_estimated) > 0),
+                               random_restarts=resolve_random_restarts)
             if self.thompson:
                 model.thompson_sample()
-            self.estimate_times[worker] = time.clock() - start
+            self.estimate_times[worker] = time.process_time() - start
             self.params_estimated[worker] = copy.deepcopy(
                 model.get_params_est())
             self.hparams_estimated[worker] = copy.deepcopy(model.hparams)
         if resolve_p:
             utime1, stime1, cutime1, cstime1, _ = os.times()
-            self.external_policy = self.run_solver(
-                model_filepath=model_filepath, policy_filepath=policy_filepath)
+            if policy_cache is not None:
+                self.external_policy = policy_cache.get_policy(self)
+            else:
+                self.external_policy = self.run_solver(
+                    model_filepath=model_filepath,
+                    policy_filepath=policy_filepath)
             utime2, stime2, cutime2, cstime2, _ = os.times()
             # All solvers are run as subprocesses, so count elapsed
             # child process time.
@@ -198,32 +229,63 @@ class Policy:
              valid_rewards[a] == max_valid_reward])
         return best_valid_action
 
-    def run_solver(self, model_filepath, policy_filepath):
+    def write_model(self, fo):
+        """Write model in the input format of the policy's solver."""
+        if self.policy == 'aitoolbox':
+            self.model.write_txt(fo)
+        else:
+            self.model.write_pomdp(fo, discount=self.discount)
+
+    def get_solver_settings(self):
+        """Return solver settings that, with the model, determine a policy."""
+        settings = {'policy': self.policy, 'discount': self.discount}
+        if self.policy == 'aitoolbox':
+            settings['horizon'] = self.horizon
+        else:
+            settings['timeout'] = self.timeout
+        return settings
+
+    def load_policy(self, policy_filepath):
+        """Load POMDPPolicy written by the policy's solver."""
+        if self.policy == 'appl':
+            return POMDPPolicy(policy_filepath,
+                               file_format='policyx')
+        elif self.policy == 'aitoolbox':
+            return POMDPPolicy(policy_filepath,
+                               file_format='aitoolbox',
+                               n_states=len(self.model.states))
+        elif self.policy == 'zmdp':
+            return POMDPPolicy(policy_filepath,
+                               file_format='zmdp',
+                               n_states=len(self.model.states))
+
+    def run_solver(self, model_filepath, policy_filepath, write_model=True):
         """Run POMDP solver.
 
         Args:
             model_filepath (str):       Path for input to POMDP solver.
             policy_filepath (str):      Path for computed policy.
+            write_model (bool):         Write model to model_filepath first.
+                                        Otherwise, assume it is already
+                                        there.
 
         Returns:
             policy (POMDPPolicy)
 
         """
         model = self.model
-        if self.policy == 'appl':
+        if self.policy not in SOLVER_POLICY_TYPES:
+            return None
+        if write_model:
             with open(model_filepath, 'w') as f:
-                model.write_pomdp(f, discount=self.discount)
+                self.write_model(f)
+        if self.policy == 'appl':
             args = ['pomdpsol-appl',
                     model_filepath,
                     '-o', policy_filepath]
             if self.timeout is not None:
                 args += ['--timeout', str(self.timeout)]
-            _ = subprocess.check_output(args)
-            return POMDPPolicy(policy_filepath,
-                               file_format='policyx')
         elif self.policy == 'aitoolbox':
-            with open(model_filepath, 'w') as f:
-                model.write_txt(f)
             args = ['pomdpsol-aitoolbox',
                     '--input', model_filepath,
                     '--output', policy_filepath,
@@ -232,23 +294,14 @@ class Policy:
                     '--n_states', str(len(model.states)),
                     '--n_actions', str(len(model.actions)),
                     '--n_observations', str(len(model.observations))]
-            _ = subprocess.check_output(args)
-            return POMDPPolicy(policy_filepath,
-                               file_format='aitoolbox',
-                               n_states=len(model.states))
         elif self.policy == 'zmdp':
-            with open(model_filepath, 'w') as f:
-                model.write_pomdp(f, discount=self.discount)
             args = [ZMDP_ALIAS,
                     'solve', model_filepath,
                     '-o', policy_filepath]
             if self.timeout is not None:
                 args += ['-t', str(self.timeout)]
-            _ = subprocess.check_output(args)
-            return POMDPPolicy(policy_filepath,
-                               file_format='zmdp',
-                               n_states=len(model.states))
-
+        _ = subprocess.check_output(args)
+        return self.load_policy(policy_filepath)
 
     def get_valid_actions(self, history):
         """Return valid action indices based on the history."""
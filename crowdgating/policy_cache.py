@@ -0,0 +1,160 @@
+"""policy_cache.py
+
+On-disk cache of solved policies, addressed by the content of the solver
+input and the solver settings.
+
+"""
+import glob
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from . import util
+from .pomdp import POMDPPolicy
+from .policy import SOLVER_POLICY_TYPES
+
+
+class PolicyCache(object):
+    """Directory of solved policies, named by a hash of what was solved.
+
+    Every solve writes its model and policy to unique scratch paths in a
+    tmp subdirectory, so concurrent solves (in threads or processes) never
+    write the same file. A finished policy is renamed into place
+    atomically, and identical models are only solved once.
+
+    """
+    def __init__(self, path, max_bytes=None, max_scratch_age=24 * 60 * 60):
+        """Initialize.
+
+        Args:
+            path (str):             Cache directory.
+            max_bytes (int):        Evict least recently used policies when
+                                    the cache is larger than this. Defaults
+                                    to no eviction.
+            max_scratch_age (int):  Remove scratch files left by crashed
+                                    solves once they are this many seconds
+                                    old. Should be longer than any solve.
+
+        """
+        self.path = path
+        self.scratch_path = os.path.join(path, 'tmp')
+        self.max_bytes = max_bytes
+        self.max_scratch_age = max_scratch_age
+
+    def get_key(self, model_str, settings):
+        """Return hash of serialized model and solver settings."""
+        h = hashlib.sha1()
+        h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        h.update(model_str.encode('utf-8'))
+        return h.hexdigest()
+
+    def get_filepath(self, key):
+        """Return path of cached policy for key."""
+        return os.path.join(self.path, '{}.bin'.format(key))
+
+    def get_policy(self, policy):
+        """Return POMDPPolicy for policy, running the solver only on a miss.
+
+        Args:
+            policy (.policy.Policy): Policy whose model to solve.
+
+        Returns:
+            POMDPPolicy
+
+        """
+        if policy.policy not in SOLVER_POLICY_TYPES:
+            raise ValueError(
+                'Policy type {} is not solved'.format(policy.policy))
+        util.ensure_dir(self.scratch_path)
+        fo = io.StringIO()
+        policy.write_model(fo)
+        model_str = fo.getvalue()
+        key = self.get_key(model_str, policy.get_solver_settings())
+        policy_filepath = self.get_filepath(key)
+        if os.path.exists(policy_filepath):
+            try:
+                os.utime(policy_filepath, None)
+                return POMDPPolicy(policy_filepath, file_format='binary')
+            except (IOError, OSError):
+                # Evicted by another process since the check.
+                pass
+
+        # Solvers expect the usual extension on their input.
+        fd, model_scratch = tempfile.mkstemp(
+            dir=self.scratch_path, prefix=key, suffix='.pomdp')
+        with io.open(fd, 'w') as f:
+            f.write(model_str)
+        fd, policy_scratch = tempfile.mkstemp(
+            dir=self.scratch_path, prefix=key, suffix='.policy')
+        os.close(fd)
+        fd, binary_scratch = tempfile.mkstemp(
+            dir=self.scratch_path, prefix=key, suffix='.bin')
+        os.close(fd)
+        try:
+            pomdp_policy = policy.run_solver(
+                model_filepath=model_scratch,
+                policy_filepath=policy_scratch,
+                write_model=False)
+            pomdp_policy.write_binary(binary_scratch)
+            os.rename(binary_scratch, policy_filepath)
+        finally:
+            for filepath in [model_scratch, policy_scratch, binary_scratch]:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+        self.evict(keep=policy_filepath)
+        return POMDPPolicy(policy_filepath, file_format='binary')
+
+    def remove_stale_scratch(self):
+        """Remove scratch files older than max_scratch_age.
+
+        Returns:
+            Total size of the scratch files kept, in bytes.
+
+        """
+        now = time.time()
+        total = 0
+        for filepath in glob.glob(os.path.join(self.scratch_path, '*')):
+            try:
+                stat = os.stat(filepath)
+                if now - stat.st_mtime > self.max_scratch_age:
+                    os.remove(filepath)
+                else:
+                    total += stat.st_size
+            except OSError:
+                continue
+        return total
+
+    def evict(self, keep=None):
+        """Remove stale scratch files, then least recently used policies
+        until under max_bytes.
+
+        Scratch files of solves in progress count toward max_bytes but are
+        never removed.
+
+        Args:
+            keep (str): Path never to remove (e.g. the policy just added).
+
+        """
+        scratch_bytes = self.remove_stale_scratch()
+        if self.max_bytes is None:
+            return
+        entries = []
+        for filepath in glob.glob(os.path.join(self.path, '*.bin')):
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+        total = scratch_bytes + sum(size for _, size, _ in entries)
+        for _, size, filepath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if filepath == keep:
+                continue
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            total -= size
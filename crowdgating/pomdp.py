@@ -2,15 +2,24 @@
 
 from __future__ import division
 import copy
+import collections
 import logging
+import multiprocessing
+import os
 import random
+import struct
 import xml.etree.ElementTree as ET
 import numpy as np
 from numpy import log
-from scipy.misc import logsumexp
+try:
+    from scipy.special import logsumexp
+except ImportError:
+    from scipy.misc import logsumexp
+import scipy.sparse
 import scipy.stats as ss
 from . import util
 from . import work_learn_problem as wlp
+from .history import History
 
 from . import zmdp_util
 
@@ -38,11 +47,34 @@ def param_to_string(p):
     return name if p[1] is None else '{}_w{}'.format(name, p[1])
 
 
+def params_key(params):
+    """Return a hashable key that changes whenever parameter values change.
+
+    Numeric values are keyed by their exact bytes, so that tables cached
+    for one set of parameters are never reused for slightly different ones.
+
+    >>> params_key({'p_leave': [0.1, 0.9]}) == params_key({'p_leave': [0.1, 0.9]})
+    True
+    >>> params_key({'p_leave': [0.1, 0.9]}) == params_key({'p_leave': [0.2, 0.8]})
+    False
+
+    """
+    key = []
+    for k in sorted(params, key=str):
+        v = params[k]
+        try:
+            v = np.asarray(v, dtype=float).tobytes()
+        except (TypeError, ValueError):
+            v = repr(v)
+        key.append((str(k), v))
+    return tuple(key)
+
+
 class POMDPModel:
     """POMDP model"""
 
     def __init__(self, n_worker_classes, params, hyperparams=None,
-                 estimate_all=False):
+                 estimate_all=False, ess_cache=None):
         """Initialize.
 
         Args:
@@ -57,6 +89,8 @@ class POMDPModel:
             hyperparams (object):   HyperParams instance.
             estimate_all (bool):    Ignore parameter values that we can
                                     estimate.
+            ess_cache (object):     ESSCache instance for reusing E-step
+                                    totals of workers across EM runs.
 
         """
         self.n_skills = len(params['p_r'])
@@ -78,7 +112,7 @@ class POMDPModel:
             'exp', 'tell', 'cost', 'cost_exp', 'cost_tell',
             'p_r', 'p_1', 'utility_type',
             'penalty_fp', 'penalty_fn', 'reward_tp', 'reward_tn',
-            'dataset', 'desired_accuracy']
+            'dataset', 'desired_accuracy', 'zmdp_discount', 'zmdp_timeout']
         if estimate_all:
             self.params = dict(
                 (k, params[k] if k in self.params_fixed else None) for
@@ -86,8 +120,28 @@ class POMDPModel:
         else:
             self.params = params
         self.hparams = None
+        # Result of the last estimate(), kept apart from self.params, which
+        # thompson_sample() overwrites.
+        self.params_em = None
 
         self.hyperparams = hyperparams
+        self.ess_cache = ess_cache
+
+        # Online EM state (see estimate_online()): average expected
+        # sufficient statistics per worker, and how many updates and workers
+        # went into them.
+        self.online_ess = None
+        self.online_updates = 0
+        self.online_workers = 0
+        # Posterior state (see update_posterior()): total expected
+        # sufficient statistics, and how many workers went into them.
+        self.posterior_ess = None
+        self.posterior_workers = 0
+
+        # Most recent tables, keyed by params_key() of the params used.
+        self._tables = dict()
+        # Parameter exponents of every cell, keyed by the parameter names.
+        self._exponents = None
 
     def get_params_est(self):
         """Return subset of parameters that are estimated"""
@@ -136,68 +190,72 @@ class POMDPModel:
 
     def write_txt(self, fo):
         """Write model to file as needed for AI-Toolbox."""
-        for s, _ in enumerate(self.states):
-            for a, _ in enumerate(self.actions):
-                for s1, _ in enumerate(self.states):
-                    fo.write('{}\t{}\t'.format(self.get_transition(s, a, s1),
-                                               sum(self.get_reward(s, a, s1)[0])))
-            fo.write('\n')
-        for s, _ in enumerate(self.states):
-            for a, _ in enumerate(self.actions):
-                for o, _ in enumerate(self.observations):
-                    fo.write('{}\t'.format(self.get_observation(s, a, o)))
-            fo.write('\n')
+        p_t, p_o, _ = self.get_tables()
+        rewards = self.get_reward_table()
+        # Each row holds (transition, reward) pairs for every (a, s1).
+        p_t_rewards = np.stack([p_t, rewards], axis=-1)
+        for row in p_t_rewards.reshape(len(self.states), -1).tolist():
+            fo.write(''.join('{}\t'.format(v) for v in row) + '\n')
+        for row in p_o.reshape(len(self.states), -1).tolist():
+            fo.write(''.join('{}\t'.format(v) for v in row) + '\n')
 
     def write_pomdp(self, fo, discount):
-        """Write a Cassandra-style POMDP spec with the given discount"""
+        """Write a Cassandra-style POMDP spec with the given discount
+
+        Only non-zero entries are written (unspecified entries are 0),
+        one block of lines per starting state.
+
+        """
         if discount >= 1.0:
             raise Exception('Discount must be less than 1.0')
+        p_t, p_o, p_i = self.get_tables()
+        rewards = self.get_reward_table()
+        states = [str(st) for st in self.states]
+        actions = [str(act) for act in self.actions]
+        observations = self.observations
+        for name, table in [('Transitions', p_t), ('Observations', p_o)]:
+            prob_sums = table.sum(axis=2)
+            invalid = np.argwhere(~np.isclose(1.0, prob_sums))
+            if len(invalid) > 0:
+                s, a = invalid[0]
+                raise Exception("{} sum to {} for s:{}, a:{}".format(
+                    name, prob_sums[s, a], states[s], actions[a]))
 
         # Write header
         fo.write('discount: {}\n'.format(discount))
         fo.write('values: reward\n')
-        fo.write('states: {}\n'.format(' '.join(str(s) for s in self.states)))
-        fo.write('actions: {}\n'.format(' '.join(str(a) for
-                                                 a in self.actions)))
-        fo.write('observations: {}\n'.format(' '.join(self.observations)))
+        fo.write('states: {}\n'.format(' '.join(states)))
+        fo.write('actions: {}\n'.format(' '.join(actions)))
+        fo.write('observations: {}\n'.format(' '.join(observations)))
 
         fo.write('start: {}\n'.format(' '.join(
-            str(x) for x in self.get_start_belief())))
+            str(x) for x in p_i.tolist())))
 
         fo.write('\n\n### Transitions\n')
-        for s, st in enumerate(self.states):
-            for a, act in enumerate(self.actions):
-                prob_sum = 0
-                for s1, st1 in enumerate(self.states):
-                    prob = self.get_transition(s, a, s1)
-                    fo.write('T: {} : {} : {} {}\n'.format(
-                        act, st, st1, prob))
-                    prob_sum += prob
-                if not np.isclose(1.0, prob_sum):
-                    raise Exception("Transitions sum to {} for s:{}, a:{}".format(prob_sum, st, act))
-                fo.write('\n')
+        for s, st in enumerate(states):
+            a_ind, s1_ind = np.nonzero(p_t[s])
+            fo.write(''.join(
+                'T: {} : {} : {} {}\n'.format(actions[a], st, states[s1], v)
+                for a, s1, v in zip(a_ind.tolist(), s1_ind.tolist(),
+                                    p_t[s, a_ind, s1_ind].tolist())))
 
         fo.write('\n\n### Observations\n')
-        for s, st in enumerate(self.states):
-            for a, act in enumerate(self.actions):
-                prob_sum = 0
-                for o, obs in enumerate(self.observations):
-                    prob = self.get_observation(s, a, o)
-                    #print 's:{}, a:{}, o:{} :: {}'.format(st, act, obs, prob)
-                    fo.write('O: {} : {} : {} {}\n'.format(
-                        act, st, obs, prob))
-                    prob_sum += prob
-                if not np.isclose(1.0, prob_sum):
-                    raise Exception("Observations sum to {} for s:{}, a:{}".format(prob_sum, st, act))
-                fo.write('\n')
+        for s, st in enumerate(states):
+            a_ind, o_ind = np.nonzero(p_o[s])
+            fo.write(''.join(
+                'O: {} : {} : {} {}\n'.format(
+                    actions[a], st, observations[o], v)
+                for a, o, v in zip(a_ind.tolist(), o_ind.tolist(),
+                                   p_o[s, a_ind, o_ind].tolist())))
 
         fo.write('\n\n### Rewards\n')
-        for s, st in enumerate(self.states):
-            for a, act in enumerate(self.actions):
-                for s1, st1 in enumerate(self.states):
-                    fo.write('R: {} : {} : {} : * {}\n'.format(
-                        act, st, st1, sum(self.get_reward(s, a, s1)[0])))
-                fo.write('\n')
+        for s, st in enumerate(states):
+            a_ind, s1_ind = np.nonzero(rewards[s])
+            fo.write(''.join(
+                'R: {} : {} : {} : * {}\n'.format(
+                    actions[a], st, states[s1], v)
+                for a, s1, v in zip(a_ind.tolist(), s1_ind.tolist(),
+                                    rewards[s, a_ind, s1_ind].tolist())))
 
     def get_start_belief(self, params=None):
         if params is None:
@@ -519,27 +577,152 @@ class POMDPModel:
             p_i (|S| array):        i       Initial belief
             rewards (|S|.|A|.|S| array):    Rewards
         """
+        p_t, p_o, p_i = self.make_probability_tables(params)
+        rewards = self.make_reward_table(params)
+        return p_t, p_o, p_i, rewards
+
+    def get_exponent_tables(self):
+        """Return sparse parameter exponents of every model probability.
+
+        Each probability is a product of parameter components raised to
+        the exponents returned by the getters with exponents=True, or a
+        constant 0 or 1 when there are no exponents. This structure only
+        depends on the states, actions, and which parameters are shared
+        across worker classes, so it is built once per model.
+
+        Returns:
+            components (list):              (param, index) of each row.
+            exponents (tuple):              Sparse matrices with one row per
+                                            component, for transitions
+                                            (|S||A||S| columns), observations
+                                            (|S||A||O| columns), and start
+                                            probabilities (|S| columns).
+            constants (tuple):              Arrays with the same columns,
+                                            1 for cells with exponents and
+                                            the constant for the others.
+
+        """
+        key = frozenset(self.params)
+        if self._exponents is not None and self._exponents[0] == key:
+            return self._exponents[1]
+
+        S = len(self.states)
+        A = len(self.actions)
+        O = len(self.observations)
+        cells = [
+            [self.get_transition(s, a, s1, exponents=True) for
+             s in range(S) for a in range(A) for s1 in range(S)],
+            [self.get_observation(s, a, o, exponents=True) for
+             s in range(S) for a in range(A) for o in range(O)],
+            [self.get_start_probability(s, exponents=True) for
+             s in range(S)]]
+        constant_getters = [
+            lambda i: self.get_transition(
+                i // (A * S), i // S % A, i % S, self.params),
+            lambda i: self.get_observation(
+                i // (A * O), i // O % A, i % O, self.params),
+            lambda i: self.get_start_probability(i, self.params)]
+
+        rows = dict()
+        coo = []
+        constants = []
+        for table, get_constant in zip(cells, constant_getters):
+            data, row_ind, col_ind = [], [], []
+            c = np.ones(len(table))
+            for col, exponents in enumerate(table):
+                if not exponents:
+                    c[col] = get_constant(col)
+                for p in exponents:
+                    for i, v in enumerate(exponents[p]):
+                        if v:
+                            data.append(v)
+                            row_ind.append(rows.setdefault((p, i), len(rows)))
+                            col_ind.append(col)
+            coo.append((data, row_ind, col_ind))
+            constants.append(c)
+        exponents = tuple(
+            scipy.sparse.csr_matrix((data, (row_ind, col_ind)),
+                                    shape=(len(rows), len(c))) for
+            (data, row_ind, col_ind), c in zip(coo, constants))
+        components = sorted(rows, key=rows.get)
+
+        self._exponents = (key, (components, exponents, tuple(constants)))
+        return self._exponents[1]
+
+    def make_probability_tables(self, params):
+        """Create transition, observation, and initial belief tables.
+
+        Unlike make_tables(), only requires estimated parameters. Tables
+        are computed from the exponent structure (see
+        get_exponent_tables()), as exp(E^T log(params)).
+
+        Returns:
+            p_t (|S|.|A|.|S| array):        Transition probabilties
+            p_o (|S|.|A|.|O| array):        Observation probabilities
+            p_i (|S| array):                Initial belief
+        """
         S = len(self.states)
         A = len(self.actions)
         O = len(self.observations)
 
-        p_t = np.zeros((S, A, S))
-        p_o = np.zeros((S, A, O))
+        components, exponents, constants = self.get_exponent_tables()
+        with np.errstate(divide='ignore'):
+            log_params = np.array(
+                [log(params[p][i]) for p, i in components], dtype=float)
+        p_t, p_o, p_i = (
+            c * np.exp(e.T.dot(log_params)) for
+            e, c in zip(exponents, constants))
+
+        return p_t.reshape(S, A, S), p_o.reshape(S, A, O), p_i
+
+    def make_reward_table(self, params):
+        """Create (|S|.|A|.|S| array) of expected cost plus reward."""
+        S = len(self.states)
+        A = len(self.actions)
+
         rewards = np.zeros((S, A, S))
         for s in range(S):
             for a in range(A):
                 for s1 in range(S):
-                    p_t[s][a][s1] = self.get_transition(s, a, s1, params)
-                    rewards[s][a][s1] = sum(
+                    rewards[s, a, s1] = sum(
                         self.get_reward(s, a, s1, params)[0])
+        return rewards
 
-                for o in range(O):
-                    p_o[s][a][o] = self.get_observation(s, a, o, params)
+    def _get_cached(self, name, params, make):
+        """Return output of make(params), rebuilding only if params changed.
 
-        # Initial beliefs
-        p_i = self.get_start_belief(params)
+        Only the most recent table for each name is kept, since EM moves
+        through a new set of parameters on every iteration.
 
-        return p_t, p_o, p_i, rewards
+        """
+        key = params_key(params)
+        if name not in self._tables or self._tables[name][0] != key:
+            tables = make(params)
+            for v in (tables if isinstance(tables, tuple) else (tables,)):
+                v.setflags(write=False)
+            self._tables[name] = (key, tables)
+        return self._tables[name][1]
+
+    def get_tables(self, params=None):
+        """Return cached probability tables (see make_probability_tables).
+
+        Tables are built once per set of parameter values, and rebuilt when
+        the values change (including in-place updates to self.params).
+        Returned arrays are read-only.
+
+        Args:
+            params: Defaults to self.params.
+
+        """
+        if params is None:
+            params = self.params
+        return self._get_cached('probabilities', params,
+                                self.make_probability_tables)
+
+    def get_reward_table(self):
+        """Return cached, read-only reward table for self.params."""
+        return self._get_cached('rewards', self.params,
+                                self.make_reward_table)
 
     def sample_SOR(self, state_num, action_num):
         '''
@@ -555,13 +738,11 @@ class POMDPModel:
 
 
         '''
-        p_s_prime = [self.get_transition(state_num, action_num, s_num) for
-                     s_num in range(len(self.states))]
-        s_prime = np.random.choice(range(len(self.states)), p=p_s_prime)
-        p_o_prime = [
-            self.get_observation(s_prime, action_num, observation_num) for
-            observation_num in range(len(self.observations))]
-        o_prime = np.random.choice(range(len(self.observations)), p=p_o_prime)
+        p_t, p_o, _ = self.get_tables()
+        s_prime = np.random.choice(len(self.states),
+                                   p=p_t[state_num, action_num])
+        o_prime = np.random.choice(len(self.observations),
+                                   p=p_o[s_prime, action_num])
         r, meta = self.get_reward(state_num, action_num, s_prime, sample=True)
         return s_prime, o_prime, r, meta
 
@@ -575,33 +756,84 @@ class POMDPModel:
         observation_num int
         return          numpy array
         '''
-        b_new_nonnormalized = []
-        for s_prime in range(len(self.states)):
-            p_o_prime = self.get_observation(
-                s_prime, action_num, observation_num)
-            summation = 0.0
-            for s in range(len(self.states)):
-                p_s_prime = self.get_transition(s, action_num, s_prime)
-                b_s = float(prev_belief[s])
-                summation = summation + p_s_prime * b_s
-            b_new_nonnormalized.append(p_o_prime * summation)
-
-        # normalize
-        b_new = []
-        total = sum(b_new_nonnormalized)
-        for b_s in b_new_nonnormalized:
-            b_new.append(b_s / total)
-        return np.array(b_new)
+        return self.update_beliefs(
+            np.asarray(prev_belief, dtype=float)[np.newaxis, :],
+            [action_num], [observation_num])[0]
+
+    def update_beliefs(self, beliefs, actions, observations):
+        """Update many beliefs at once.
+
+        Computes b' = O[:, a, o] * (T[:, a, :]^T b), normalized, for each
+        row, grouping rows by action so that each group is a single
+        matrix product.
+
+        Args:
+            beliefs (|W|.|S| array):    One belief per row.
+            actions (|W| array):        Action index for each row.
+            observations (|W| array):   Observation index for each row.
+
+        Returns:
+            |W|.|S| array of new beliefs.
+
+        """
+        p_t, p_o, _ = self.get_tables()
+        beliefs = np.asarray(beliefs, dtype=float)
+        actions = np.asarray(actions, dtype=int)
+        observations = np.asarray(observations, dtype=int)
+        b_new = np.empty_like(beliefs)
+        for a in np.unique(actions):
+            rows = actions == a
+            b_new[rows] = np.dot(beliefs[rows], p_t[:, a, :])
+        b_new *= p_o[:, actions, observations].T
+        return b_new / b_new.sum(axis=1, keepdims=True)
+
+    def get_beliefs(self, history, beliefs=None):
+        """Replay every worker in a history and return current beliefs.
+
+        Workers are advanced in lockstep, one time step per call to
+        update_beliefs(), so the cost is a few matrix products per step
+        rather than a Python loop over workers and states.
+
+        Args:
+            history:    History object.
+            beliefs:    Beliefs before the recorded actions (|W|.|S| array,
+                        or a single |S| belief shared by all workers).
+                        Defaults to the start belief.
+
+        Returns:
+            |W|.|S| array with the current belief of each worker.
+
+        """
+        n_workers = history.n_workers()
+        if beliefs is None:
+            beliefs = self.get_tables()[2]
+        beliefs = np.array(np.broadcast_to(
+            beliefs, (n_workers, len(self.states))), dtype=float)
+        lengths = np.array([history.n_t(w) for w in range(n_workers)],
+                           dtype=int)
+        for t in range(lengths.max() if n_workers else 0):
+            workers = np.flatnonzero(lengths > t)
+            actions = [history.history[w][t][0] for w in workers]
+            observations = [history.history[w][t][1] for w in workers]
+            beliefs[workers] = self.update_beliefs(
+                beliefs[workers], actions, observations)
+        return beliefs
 
     def expected_sufficient_statistics(self, log_marginals,
                                        log_pairwise_marginals, history):
         """Make tables with expected sufficient statistics
 
+        Marginals are consumed one worker at a time, so both arguments may
+        be generators (see iter_unnormalized_marginals()), and each worker
+        is added to the tables with a single scatter-add per table.
+
         Args:
-            log_marginals:          list of unnormalized log marginals
-                                    (np.arrays of (|T+1| x |S|))
-            log_pairwise_marginals: list of unnormalized log marginal pairs
-                                    (np.arrays of (|T| x |S| x |S|))
+            log_marginals:          iterable of unnormalized log marginals
+                                    (np.arrays of (|T+1| x |S|)), one per
+                                    worker with at least one step
+            log_pairwise_marginals: iterable of unnormalized log marginal
+                                    pairs (np.arrays of (|T| x |S| x |S|))
+            history:                History object
 
         Returns:
             ess_t:  Expected sufficient statistics for transitions.
@@ -611,27 +843,80 @@ class POMDPModel:
         S = len(self.states)
         A = len(self.actions)
         O = len(self.observations)
-        ess_t = np.zeros((S, A, S))
-        ess_o = np.zeros((S, A, O))
+        ess_t = np.zeros(S * A * S)
+        ess_o = np.zeros(S * A * O)
         ess_i = np.zeros((S))
-        for worker, m in enumerate(log_marginals):
+        s = np.arange(S)
+        workers_AO = (w for w in history.history if len(w) > 0)
+        for worker_AO, m, pm in zip(workers_AO, log_marginals,
+                                    log_pairwise_marginals):
+            a, o = np.array([x[:2] for x in worker_AO], dtype=int).T
             m_norm = np.exp(m - logsumexp(m, axis=1, keepdims=True))
-            T = history.n_t(worker)
-            for t in range(T):
-                for s in range(S):
-                    a, o, _ = history.history[worker][t]
-                    ess_o[s][a][o] += m_norm[t + 1][s]
+            pm_norm = np.exp(pm - logsumexp(pm, axis=(1, 2), keepdims=True))
+
+            # Flat indices of (s, a, o) and (s, a, s1) cells for each step.
+            i_o = (s * A * O)[np.newaxis, :] + (a * O + o)[:, np.newaxis]
+            i_t = ((s * A * S)[np.newaxis, :, np.newaxis] +
+                   (a * S)[:, np.newaxis, np.newaxis] +
+                   s[np.newaxis, np.newaxis, :])
+            ess_o += np.bincount(i_o.ravel(), weights=m_norm[1:].ravel(),
+                                 minlength=ess_o.size)
+            ess_t += np.bincount(i_t.ravel(), weights=pm_norm.ravel(),
+                                 minlength=ess_t.size)
             ess_i += m_norm[0, :]
+        return ess_t.reshape(S, A, S), ess_o.reshape(S, A, O), ess_i
 
-        for worker, pm in enumerate(log_pairwise_marginals):
-            pm_norm = np.exp(pm - logsumexp(pm, axis=(1, 2), keepdims=True))
-            T = history.n_t(worker)
+    def iter_unnormalized_marginals(self, params, history):
+        """Yield unnormalized marginals one worker at a time.
+
+        Workers with no steps are skipped.
+
+        Args:
+            params:     Model parameters.
+            history:    History object
+
+        Yields:
+            tuple(log_marginals, log_pairwise_marginals, log_likelihood)
+            for a single worker (see get_unnormalized_marginals()).
+
+        """
+        S = len(self.states)
+        p_t, p_o, p_i = self.get_tables(params)
+        with np.errstate(divide='ignore'):
+            log_p_t = log(p_t)
+            log_p_o = log(p_o)
+            log_p_i = log(p_i)
+        for worker_AO in history.history:
+            T = len(worker_AO)
+            if T == 0:
+                continue
+            a, o = np.array([x[:2] for x in worker_AO], dtype=int).T
+
+            # log P(s1, o | s0, a) for each step, as (|T| x |S| x |S|).
+            log_p_to = (log_p_t[:, a, :].transpose(1, 0, 2) +
+                        log_p_o[:, a, o].T[:, np.newaxis, :])
+
+            # Forward-backward init.
+            alpha = np.zeros((T + 1, S))
+            beta = np.zeros((T + 1, S))
+            alpha[0] = log_p_i
+
+            # Forward.
             for t in range(T):
-                a, o, _ = history.history[worker][t]
-                for s in range(S):
-                    for s1 in range(S):
-                        ess_t[s][a][s1] += pm_norm[t][s][s1]
-        return ess_t, ess_o, ess_i
+                alpha[t + 1] = logsumexp(
+                    alpha[t][:, np.newaxis] + log_p_to[t], axis=0)
+
+            # Backward.
+            for t in reversed(range(T)):
+                beta[t] = logsumexp(
+                    log_p_to[t] + beta[t + 1][np.newaxis, :], axis=1)
+
+            # Make pairwise marginals
+            # BUG: should this be s1 or s
+            yield (alpha + beta,
+                   alpha[:-1, :, np.newaxis] + log_p_to +
+                   beta[1:, np.newaxis, :],
+                   logsumexp(alpha[T, :]))
 
     def get_unnormalized_marginals(self, params, history):
         """Estimate unnormalized marginals from provided model parameters
@@ -649,71 +934,131 @@ class POMDPModel:
                 log_likelihood:         Log-likelihood 
         
         """
-        S = len(self.states)
         ll = 0
         log_marginals = []
         log_pairwise_marginals = []
-        for worker_AO in history.history:
-            T = len(worker_AO)
-            if T == 0:
-                continue
+        for m, pm, worker_ll in self.iter_unnormalized_marginals(
+                params, history):
+            log_marginals.append(m)
+            log_pairwise_marginals.append(pm)
+            ll += worker_ll
+        return log_marginals, log_pairwise_marginals, ll
 
-            # Forward-backward init.
-            alpha = np.zeros((T + 1, S))
-            beta = np.zeros((T + 1, S))
-            for s in range(S):
-                p_i = self.get_start_probability(s, params)
-                alpha[0][s] = log(p_i)
-                beta[T][s] = log(1.0)
+    def _get_log_step_tables(self, log_p_t, log_p_o, actions, observations):
+        """Return log P(s1, o | s0, a) for one step of many workers.
 
-            # Forward.
-            for t in range(T):
-                a, o, _ = worker_AO[t]
-                for s1 in range(S):
-                    v = []
-                    for s0 in range(S):
-                        p_t = self.get_transition(s0, a, s1, params)
-                        p_o = self.get_observation(s1, a, o, params)
-                        v.append(alpha[t][s0] + log(p_t) + log(p_o))
-                    alpha[t + 1][s1] = logsumexp(v)
+        Returns:
+            |W|.|S|.|S| array.
 
-            # Backward.
-            for t in reversed(range(T)):
-                a, o, _ = worker_AO[t]
-                for s0 in range(S):
-                    v = []
-                    for s1 in range(S):
-                        p_t = self.get_transition(s0, a, s1, params)
-                        p_o = self.get_observation(s1, a, o, params)
-                        v.append(beta[t + 1][s1] + log(p_t) + log(p_o))
-                    beta[t][s0] = logsumexp(v)
+        """
+        return (log_p_t[:, actions, :].transpose(1, 0, 2) +
+                log_p_o[:, actions, observations].T[:, np.newaxis, :])
 
-            log_marginals.append(alpha + beta)
+    def forward_backward(self, params, actions, observations, lengths):
+        """Get expected sufficient statistics for many workers at once.
 
-            # Make pairwise marginals
-            pm = np.zeros((T, S, S))
-            for t in range(T):
-                a, o, _ = worker_AO[t]
-                for s in range(S):
-                    for s1 in range(S):
-                        p_t = self.get_transition(s, a, s1, params)
-                        p_o = self.get_observation(s1, a, o, params)
-                        pm[t][s][s1] = alpha[t][s] + log(p_t) + log(p_o) + \
-                            beta[t + 1][s1]  # BUG: should this be s1 or s
-            log_pairwise_marginals.append(pm)
+        Runs forward-backward over padded arrays (see History.pack()),
+        advancing workers in lockstep so that each step is a few array
+        operations regardless of the number of workers. Workers are
+        sorted by length, so step t only touches the workers with more
+        than t steps, and messages are kept only for those, making time
+        and memory proportional to the total number of steps rather than
+        to |W| times the longest history. Workers with no steps are
+        ignored.
 
-            # Update likelihood
-            ll += logsumexp(alpha[T, :])
+        Args:
+            params:                             Model parameters.
+            actions (|W|.|Tmax| array):         Padded actions.
+            observations (|W|.|Tmax| array):    Padded observations.
+            lengths (|W| array):                Steps taken with each
+                                                worker.
 
-        return log_marginals, log_pairwise_marginals, ll
+        Returns:
+            ess_t:  Expected sufficient statistics for transitions.
+            ess_o:  Expected sufficient statistics for observations.
+            ess_i:  Expected sufficient statistics for initial probabilities.
+            ll:     Log-likelihood.
+
+        """
+        S = len(self.states)
+        A = len(self.actions)
+        O = len(self.observations)
+        p_t, p_o, p_i = self.get_tables(params)
+        with np.errstate(divide='ignore'):
+            log_p_t = log(p_t)
+            log_p_o = log(p_o)
+            log_p_i = log(p_i)
+
+        # Longest first, so the workers with more than t steps are the
+        # first n_active[t] rows.
+        order = np.argsort(-lengths, kind='stable')
+        order = order[lengths[order] > 0]
+        lengths = lengths[order]
+        actions = actions[order]
+        observations = observations[order]
+        T = lengths[0] if len(lengths) else 0
+        n_active = np.searchsorted(-lengths, -np.arange(T), side='left')
+
+        # Forward. alpha[t] has a row for each worker with at least t steps
+        # (all workers for t = 0).
+        alpha = [np.tile(log_p_i, (len(lengths), 1))]
+        worker_ll = np.zeros(len(lengths))
+        for t in range(T):
+            n = n_active[t]
+            log_p_to = self._get_log_step_tables(
+                log_p_t, log_p_o, actions[:n, t], observations[:n, t])
+            alpha.append(logsumexp(
+                alpha[t][:n, :, np.newaxis] + log_p_to, axis=1))
+            n_next = n_active[t + 1] if t + 1 < T else 0
+            worker_ll[n_next:n] = logsumexp(alpha[t + 1][n_next:], axis=1)
+
+        # Backward, accumulating marginals (indexed by action) as we go.
+        ess_t_a = np.zeros((A, S, S))
+        ess_o_a = np.zeros((A, O, S))
+        beta = np.zeros((0, S))
+        for t in reversed(range(T)):
+            n = n_active[t]
+            a = actions[:n, t]
+            o = observations[:n, t]
+            ll = worker_ll[:n, np.newaxis]
+            # Workers whose last step is t start with beta = log(1).
+            beta = np.concatenate([beta, np.zeros((n - len(beta), S))])
+            np.add.at(ess_o_a, (a, o), np.exp(alpha[t + 1] + beta - ll))
+            log_p_to = self._get_log_step_tables(log_p_t, log_p_o, a, o)
+            np.add.at(ess_t_a, a, np.exp(
+                alpha[t][:n, :, np.newaxis] + log_p_to +
+                beta[:, np.newaxis, :] - ll[:, :, np.newaxis]))
+            beta = logsumexp(log_p_to + beta[:, np.newaxis, :], axis=2)
+            alpha[t + 1] = None
+        ess_i = np.exp(alpha[0] + beta - worker_ll[:, np.newaxis]).sum(axis=0)
+
+        return (ess_t_a.transpose(1, 0, 2), ess_o_a.transpose(2, 0, 1), ess_i,
+                worker_ll.sum())
+
+    def estimate_E(self, history, params, use_cache=False, ess_out=None):
+        """Get expected sufficient statistics
+
+        Args:
+            history:    History object, or arrays from History.pack().
+            params:     Model parameters.
+            use_cache:  Reuse totals from the ess_cache, if any. Only worth
+                        it for parameters an earlier E-step was run at
+                        (e.g. a warm start).
+            ess_out:    Optional list, set to the statistics before the
+                        param likelihood is added (see
+                        ESSCache.put_ess()).
 
-    def estimate_E(self, history, params):
-        """Get expected sufficient statistics"""
+        """
         logging.debug('Estimating E step')
-        log_marginals, log_pairwise_marginals, ll = \
-            self.get_unnormalized_marginals(params, history)
-        ess_t, ess_o, ess_i = self.expected_sufficient_statistics(
-            log_marginals, log_pairwise_marginals, history)
+        if isinstance(history, History):
+            history = history.pack()
+        if use_cache and self.ess_cache is not None:
+            ess = self.ess_cache.get_ess(self, params, *history)
+        else:
+            ess = self.forward_backward(params, *history)
+        if ess_out is not None:
+            ess_out[:] = ess
+        ess_t, ess_o, ess_i, ll = ess
 
         # Add param likelihood.
         for p in params:
@@ -721,70 +1066,182 @@ class POMDPModel:
 
         return ess_t, ess_o, ess_i, ll
 
+    def get_posterior_counts(self, ess_t, ess_o, ess_i):
+        """Return Dirichlet posterior parameters given expected statistics.
+
+        Returns:
+            Dictionary with hyperparameters plus the expected number of
+            times each parameter component was used.
+
+        """
+        components, exponents, _ = self.get_exponent_tables()
+        e_t, e_o, e_i = exponents
+        counts = (e_t.dot(np.ravel(ess_t)) + e_o.dot(np.ravel(ess_o)) +
+                  e_i.dot(ess_i))
+
+        params = copy.deepcopy(self.hyperparams.p)
+        for (p, i), v in zip(components, counts):
+            params[p][i] += v
+        return params
+
     def estimate_M(self, ess_t, ess_o, ess_i):
         """Perform M step for EM."""
         logging.debug('Estimating M step')
-        S = len(self.states)
-        A = len(self.actions)
-        O = len(self.observations)
-
-        params = copy.deepcopy(self.hyperparams.p)
-        for s in range(S):
-            exponents = self.get_start_probability(s, exponents=True)
-            for p in exponents:
-                for i, v in enumerate(exponents[p]):
-                    params[p][i] += ess_i[s] * v
-            for a in range(A):
-                for s1 in range(S):
-                    exponents = self.get_transition(s, a, s1, exponents=True)
-                    for p in exponents:
-                        for i, v in enumerate(exponents[p]):
-                            params[p][i] += ess_t[s][a][s1] * v
-                for o in range(O):
-                    exponents = self.get_observation(s, a, o, exponents=True)
-                    for p in exponents:
-                        for i, v in enumerate(exponents[p]):
-                            params[p][i] += ess_o[s][a][o] * v
+        params = self.get_posterior_counts(ess_t, ess_o, ess_i)
         map_estimate = dict((p, util.dirichlet_mode(params[p])) for
                             p in params)
         return map_estimate, params
 
-    def estimate_once(self, history, random_init, ll_max_improv):
-        """Run EM starting from a single initialization."""
+    def iter_estimate(self, history, random_init, seed=None, ess_out=None):
+        """Run EM from a single initialization, one iteration at a time.
+
+        Only the first E-step of a warm start uses the ess_cache; later
+        E-steps are at new parameters and could never hit it.
+
+        Args:
+            history:        History object, or arrays from History.pack().
+            random_init:    Initialize from the hyperparameters rather than
+                            the result of the last estimate() (or the
+                            current parameter values, before the first).
+            seed:           Seed for the random initialization. Defaults
+                            to the global numpy random state.
+            ess_out:        Optional list, set to the statistics of the
+                            E-step at each yielded params (see
+                            estimate_E()).
+
+        Yields:
+            (params, hparams, ll), first for the initialization (with
+            hparams None) and then after each EM iteration, indefinitely.
+
+        """
         if random_init:
+            rng = np.random if seed is None else np.random.RandomState(seed)
             params = dict()
             for p in self.params:
                 if p not in self.params_fixed:
-                    params[p] = np.random.dirichlet(self.hyperparams.p[p])
+                    params[p] = rng.dirichlet(self.hyperparams.p[p])
         else:
-            params = dict((k, copy.copy(self.params[k])) for
+            last = self.params if self.params_em is None else self.params_em
+            params = dict((k, copy.copy(last[k])) for
                           k in self.params if k not in self.params_fixed)
 
-        ess_t, ess_o, ess_i, ll = self.estimate_E(history, params)
-        ll_improv = float('inf')
-        t = 0
-        #print 'EM step {}: {} ({})'.format(t, ll, ll_improv)
-        #print params
-        while (np.isnan(ll_improv) or ll_improv > ll_max_improv):
-            t += 1
+        if isinstance(history, History):
+            history = history.pack()
+        ess_t, ess_o, ess_i, ll = self.estimate_E(
+            history, params, use_cache=not random_init, ess_out=ess_out)
+        yield params, None, ll
+        while True:
             params, hparams = self.estimate_M(ess_t, ess_o, ess_i)
-            ess_t, ess_o, ess_i, ll_new = self.estimate_E(history, params)
+            ess_t, ess_o, ess_i, ll = self.estimate_E(
+                history, params, ess_out=ess_out)
+            yield params, hparams, ll
+
+    def estimate_once(self, history, random_init, ll_max_improv, seed=None,
+                      ess_out=None):
+        """Run EM starting from a single initialization.
+
+        Args:
+            seed: Seed for the random initialization. Defaults to the global
+                  numpy random state.
+            ess_out: Optional list, set to the statistics of the last E-step
+                     (see estimate_E()).
+
+        """
+        steps = self.iter_estimate(history, random_init, seed, ess_out)
+        _, _, ll = next(steps)
+        for t, (params, hparams, ll_new) in enumerate(steps, 1):
             ll_improv = abs((ll_new - ll) / ll)
             ll = ll_new
             #print 'EM step {}: {} ({})'.format(t, ll, ll_improv)
-            #print params
+            if not (np.isnan(ll_improv) or ll_improv > ll_max_improv):
+                break
 
         return params, hparams, ll
 
+    def estimate_race(self, history, tasks, race_iterations, race_margin,
+                      ess_outs=None):
+        """Run EM for several initializations in lockstep.
+
+        After race_iterations iterations, runs whose log-likelihood trails
+        the best run by more than race_margin (as a fraction of the best
+        log-likelihood) are stopped early.
+
+        Args:
+            history:            History object, or arrays from
+                                History.pack().
+            tasks:              List of (random_init, ll_max_improv, seed)
+                                (see estimate_once()).
+            race_iterations:    Iterations before runs are dropped.
+            race_margin:        Fraction of log-likelihood a run may trail
+                                the best run by.
+            ess_outs:           Optional list of lists, one per task, set
+                                to the statistics of each run's last E-step
+                                (see estimate_E()).
+
+        Returns:
+            List of (params, hparams, ll), one per task, for the last
+            iteration each run completed.
+
+        """
+        if isinstance(history, History):
+            history = history.pack()
+        steps = []
+        lls = []
+        results = []
+        for i, (random_init, _, seed) in enumerate(tasks):
+            steps.append(self.iter_estimate(
+                history, random_init, seed,
+                None if ess_outs is None else ess_outs[i]))
+            lls.append(next(steps[-1])[2])
+            results.append(None)
+        active = list(range(len(tasks)))
+        t = 0
+        while active:
+            t += 1
+            converged = set()
+            for i in active:
+                results[i] = next(steps[i])
+                ll_improv = abs((results[i][2] - lls[i]) / lls[i])
+                lls[i] = results[i][2]
+                if not (np.isnan(ll_improv) or ll_improv > tasks[i][1]):
+                    converged.add(i)
+            active = [i for i in active if i not in converged]
+            ll_lead = max(lls)
+            if t >= race_iterations and np.isfinite(ll_lead):
+                ll_min = ll_lead - race_margin * abs(ll_lead)
+                dropped = [i for i in active if not lls[i] >= ll_min]
+                if dropped:
+                    logging.debug('Dropping EM runs %s at iteration %d',
+                                  dropped, t)
+                active = [i for i in active if i not in dropped]
+        return results
+
     def estimate(self, history, last_params=True, random_restarts=1,
-                 ll_max_improv=0.001):
+                 ll_max_improv=0.001, processes=None, race_iterations=None,
+                 race_margin=0.01):
         """Estimate parameters from history.
 
+        Each random restart is seeded from the global numpy random state,
+        so results are the same whether or not restarts run in parallel.
+
         Args:
-            history: History object.
-            last_params: Initialize from last parameter values.
+            history: History object, or arrays from History.pack().
+            last_params: Initialize from last parameter values. When the
+                         model has an ess_cache, the totals of the final
+                         E-step of the best run are stored, so the first
+                         E-step of the next warm start only processes
+                         new workers.
             random_restarts: Number of random initializations to perform.
             ll_max_improv: Threshold of % log-likelihood improvement.
+            processes: Run restarts in a pool of this many processes.
+                       The model and packed history are sent to each
+                       process once. Defaults to running in this process.
+            race_iterations: Run restarts in lockstep, and after this many
+                             iterations stop those that trail the best
+                             (see estimate_race()). Not used with
+                             processes.
+            race_margin: Fraction of log-likelihood a restart may trail
+                         the best by when racing.
 
         Returns:
             ll_best: Final log likelihood
@@ -794,27 +1251,142 @@ class POMDPModel:
         params_best = None
         hparams_best = None
         ll_best = float('-inf')
+        if isinstance(history, History):
+            history = history.pack()
 
         # Run EM.
+        tasks = []
         if last_params:
-            params, hparams, ll = self.estimate_once(
-                history, random_init=False, ll_max_improv=ll_max_improv)
-            if ll > ll_best:
-                params_best = params
-                hparams_best = hparams
-                ll_best = ll
-        for i in range(random_restarts):
-            params, hparams, ll = self.estimate_once(
-                history, random_init=True, ll_max_improv=ll_max_improv)
+            tasks.append((False, ll_max_improv, None))
+        for seed in np.random.randint(2**31 - 1, size=random_restarts):
+            tasks.append((True, ll_max_improv, seed))
+        ess_outs = [[] for _ in tasks]
+        if race_iterations is not None:
+            if processes is not None:
+                raise ValueError('Racing restarts run in a single process')
+            results = self.estimate_race(history, tasks, race_iterations,
+                                         race_margin, ess_outs)
+        elif processes is None:
+            results = [self.estimate_once(history, *task, ess_out=ess_out)
+                       for task, ess_out in zip(tasks, ess_outs)]
+        else:
+            pool = multiprocessing.Pool(
+                processes=processes, initializer=_init_estimate_worker,
+                initargs=(self, history))
+            try:
+                results_ess = pool.map(_estimate_once_worker, tasks)
+            finally:
+                pool.terminate()
+            results = [r for r, _ in results_ess]
+            ess_outs = [ess for _, ess in results_ess]
+        ess_best = None
+        for (params, hparams, ll), ess in zip(results, ess_outs):
             if ll > ll_best:
                 params_best = params
                 hparams_best = hparams
                 ll_best = ll
+                ess_best = ess
+        if self.ess_cache is not None and ess_best:
+            self.ess_cache.put_ess(params_best, history[2], ess_best)
 
         self.params.update(params_best)
+        self.params_em = params_best
         self.hparams = hparams_best
         return ll_best, params_best
 
+    def estimate_online(self, history, step_size_exponent=0.6):
+        """Update parameters with online EM, using only new workers.
+
+        Keeps the average expected sufficient statistics per worker, and on
+        the k-th update (k = 0, 1, ...) moves them towards the statistics
+        of the new workers under the current parameters, with step size
+        (k + 1) ** -step_size_exponent. New parameters are the MAP
+        estimate from the average statistics scaled to the number of
+        workers seen, so each update costs the same however many workers
+        came before.
+
+        Args:
+            history:            History object. Workers after the last one
+                                used by a previous call must be finished.
+            step_size_exponent: Step size decay, in (0.5, 1]. Use 1 for a
+                                plain running average.
+
+        Returns:
+            ll: Log likelihood of the new workers before the update
+            params: Parameters after the update
+
+        """
+        workers = range(self.online_workers, history.n_workers())
+        if len(workers) == 0:
+            return 0, self.get_params_est()
+
+        ess_t, ess_o, ess_i, ll = self.forward_backward(
+            self.get_params_current(), *history.pack(workers))
+
+        gamma = (self.online_updates + 1) ** -step_size_exponent
+        ess_new = [v / len(workers) for v in (ess_t, ess_o, ess_i)]
+        if self.online_ess is None:
+            self.online_ess = ess_new
+        else:
+            self.online_ess = [(1 - gamma) * v + gamma * v_new for
+                               v, v_new in zip(self.online_ess, ess_new)]
+        self.online_updates += 1
+        self.online_workers += len(workers)
+
+        params, self.hparams = self.estimate_M(
+            *[self.online_workers * v for v in self.online_ess])
+        self.params.update(params)
+        self.params_em = params
+        return ll, params
+
+    def get_params_current(self):
+        """Return best current estimate of the estimated parameters.
+
+        Uses the result of the last estimate, or self.params before any.
+        Parameters that have no value yet are drawn from the prior.
+
+        """
+        last = self.params if self.params_em is None else self.params_em
+        params = dict()
+        for p in self.params:
+            if p not in self.params_fixed:
+                if last[p] is None:
+                    params[p] = np.random.dirichlet(self.hyperparams.p[p])
+                else:
+                    params[p] = last[p]
+        return params
+
+    def update_posterior(self, history):
+        """Add newly finished workers to the Dirichlet posterior.
+
+        Expected sufficient statistics of workers added since the last
+        call, under the current parameter estimate, are added to running
+        totals, and self.hparams is set to the hyperparameters plus the
+        resulting counts. Unlike estimate(), earlier workers are not
+        revisited, so the cost only depends on the new workers. Use
+        thompson_sample() to draw parameters from the posterior.
+
+        Args:
+            history: History object. Workers after the last one used by a
+                     previous call must be finished.
+
+        Returns:
+            Posterior parameters (self.hparams).
+
+        """
+        workers = range(self.posterior_workers, history.n_workers())
+        if len(workers) > 0 or self.hparams is None:
+            ess = self.forward_backward(
+                self.get_params_current(), *history.pack(workers))[:3]
+            if self.posterior_ess is None:
+                self.posterior_ess = ess
+            else:
+                self.posterior_ess = [
+                    v + v_new for v, v_new in zip(self.posterior_ess, ess)]
+            self.posterior_workers += len(workers)
+            self.hparams = self.get_posterior_counts(*self.posterior_ess)
+        return self.hparams
+
     def thompson_sample(self):
         """Reset self.params by sampling from self.hparams"""
         d = self.hparams
@@ -836,10 +1408,26 @@ class POMDPPolicy:
 
         pMatrix        The policy matrix, constructed from all of the
                        alpha vectors.
+
+        support        For zMDP policies, boolean matrix with the entries
+                       defined by each alpha vector (others are 0 in
+                       pMatrix). None for other formats.
+
+    Alpha vectors are stored sorted by action, so that per-action maxima
+    are a single grouped reduction.
+
+    Any policy can be saved with write_binary() and loaded again with
+    file_format='binary', which memory-maps the arrays instead of parsing
+    them, so processes loading the same file share one page-cached copy.
     '''
 
+    BINARY_MAGIC = b'CGPOLICY'
+    # Magic, version, n_planes, n_states, alpha itemsize, has support.
+    BINARY_HEADER = struct.Struct('<8sQQQQQ')
+
     def __init__(self, filename, file_format='policyx', n_states=None):
         self.file_format = file_format
+        self._unsupported = None
         if file_format == 'policyx':
             tree = ET.parse(filename)
             root = tree.getroot()
@@ -876,19 +1464,84 @@ class POMDPPolicy:
             self.action_nums = [int(line.split()[n_states]) for
                                 line in lines_max_horizon]
         elif file_format == 'zmdp':
-            actions, alphas = zmdp_util.read_zmdp_policy(filename, n_states)
-            self.action_nums = actions
-            self.pMatrix = np.array(alphas)
+            actions, alphas, support = zmdp_util.read_zmdp_policy(
+                filename, n_states)
+            self.action_nums = actions.tolist()
+            self.pMatrix = alphas
+            self._unsupported = ~support
+        elif file_format == 'binary':
+            self._read_binary(filename)
         else:
             raise NotImplementedError
+        self._sort_by_action()
+
+    @property
+    def support(self):
+        if self._unsupported is None:
+            return None
+        return ~self._unsupported
+
+    def _read_binary(self, filename):
+        """Memory-map policy written by write_binary()."""
+        with open(filename, 'rb') as f:
+            header = f.read(self.BINARY_HEADER.size)
+        (magic, version, n_planes, n_states, itemsize,
+         has_support) = self.BINARY_HEADER.unpack(header)
+        if magic != self.BINARY_MAGIC or version != 1:
+            raise Exception('Unrecognized binary policy')
+        offset = self.BINARY_HEADER.size
+        arrays = []
+        for dtype, shape in [
+                (np.int64, (n_planes,)),
+                (np.dtype('f{}'.format(itemsize)), (n_planes, n_states)),
+                (np.bool_, (n_planes, n_states) if has_support else None)]:
+            if shape is None:
+                arrays.append(None)
+                continue
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if size == 0:
+                arrays.append(np.zeros(shape, dtype=dtype))
+            else:
+                arrays.append(np.memmap(filename, dtype=dtype, mode='r',
+                                        offset=offset, shape=shape))
+            offset += size
+        actions, self.pMatrix, self._unsupported = arrays
+        self.action_nums = actions.tolist()
 
-    def zmdp_filter(self, belief, alpha):
-        """Return true iff this alpha vector applies to this belief"""
-        return not any(b > 0 and a is None for b, a in zip(belief, alpha))
+    def write_binary(self, filename, dtype=np.float64):
+        """Write policy in the binary format read with file_format='binary'.
 
-    def zmdp_convert(self, alpha):
-        """Return new array with Nones replaced with 0's"""
-        return [a if a is not None else 0 for a in alpha]
+        Args:
+            filename (str): Output path.
+            dtype:          Alpha vector dtype (np.float64 or np.float32).
+
+        """
+        alphas = np.ascontiguousarray(self.pMatrix, dtype=dtype)
+        n_planes, n_states = alphas.shape
+        with open(filename, 'wb') as f:
+            f.write(self.BINARY_HEADER.pack(
+                self.BINARY_MAGIC, 1, n_planes, n_states,
+                alphas.dtype.itemsize, self._unsupported is not None))
+            f.write(np.asarray(self.action_nums, dtype=np.int64).tobytes())
+            f.write(alphas.tobytes())
+            if self._unsupported is not None:
+                f.write(np.ascontiguousarray(
+                    self._unsupported, dtype=np.bool_).tobytes())
+
+    def _sort_by_action(self):
+        """Sort alpha vectors by action and index the action groups."""
+        action_nums = np.asarray(self.action_nums, dtype=int)
+        order = np.argsort(action_nums, kind='mergesort')
+        if np.any(order != np.arange(len(order))):
+            action_nums = action_nums[order]
+            self.action_nums = action_nums.tolist()
+            self.pMatrix = self.pMatrix[order]
+            if self._unsupported is not None:
+                self._unsupported = self._unsupported[order]
+        self._group_starts = np.flatnonzero(
+            np.r_[True, action_nums[1:] != action_nums[:-1]]
+            [:len(action_nums)])
+        self._group_actions = action_nums[self._group_starts]
 
     def get_best_action(self, belief):
         '''
@@ -912,27 +1565,61 @@ class POMDPPolicy:
         Returns dictionary:
             action-num: max expected-reward.
         '''
-        if self.file_format == 'zmdp':
-            alpha_indices_relevant = [
-                i for i, alpha in enumerate(self.pMatrix) if
-                self.zmdp_filter(belief, alpha)]
-            alphas = []
-            actions = []
-            for i in alpha_indices_relevant:
-                alphas.append(self.zmdp_convert(self.pMatrix[i, :]))
-                actions.append(self.action_nums[i])
-            alphas = np.array(alphas)
-        else:
-            alphas = self.pMatrix
-            actions = self.action_nums
-        res = alphas.dot(belief)
-        d = dict()
-        for a, r in zip(actions, res):
-            if a not in d:
-                d[a] = r
-            else:
-                d[a] = max(d[a], r)
-        return d
+        actions, rewards = self.get_action_rewards_batch(
+            np.asarray(belief, dtype=float)[np.newaxis, :])
+        return dict((a, r) for a, r in zip(actions.tolist(), rewards[0]) if
+                    r > -np.inf)
+
+    def get_action_rewards_batch(self, beliefs):
+        """Return max expected reward of each action for many beliefs.
+
+        For zMDP policies, alpha vectors that are not defined for every
+        state with positive belief are excluded, using one boolean matrix
+        product.
+
+        Args:
+            beliefs (|B|.|S| array):  One belief per row.
+
+        Returns:
+            actions (array):            Action numbers (columns of rewards).
+            rewards (|B|.|actions|):    Max expected reward, or -inf if no
+                                        alpha vector for the action applies.
+
+        """
+        beliefs = np.asarray(beliefs, dtype=float)
+        if len(self._group_starts) == 0:
+            return self._group_actions, np.empty((len(beliefs), 0))
+        res = np.dot(beliefs.astype(self.pMatrix.dtype), self.pMatrix.T)
+        if self._unsupported is not None:
+            res[np.dot(beliefs > 0, self._unsupported.T)] = -np.inf
+        return (self._group_actions,
+                np.maximum.reduceat(res, self._group_starts, axis=1))
+
+
+# Model and packed history for estimate() restarts in pool processes.
+_ESTIMATE_WORKER = dict()
+
+
+def _init_estimate_worker(model, history):
+    """Pool initializer for POMDPModel.estimate()."""
+    util.init_worker()
+    _ESTIMATE_WORKER['model'] = model
+    _ESTIMATE_WORKER['history'] = history
+
+
+def _estimate_once_worker(task):
+    """Run POMDPModel.estimate_once() for (random_init, ll_max_improv, seed)
+    in a pool process.
+
+    Returns:
+        Result of estimate_once() and statistics of its last E-step.
+
+    """
+    ess_out = []
+    result = util.run_functor(_ESTIMATE_WORKER['model'].estimate_once,
+                              _ESTIMATE_WORKER['history'], *task,
+                              ess_out=ess_out)
+    return result, ess_out
 
 
 def main_estimate(tup):
@@ -951,6 +1638,149 @@ def main_estimate(tup):
             'bic_penalty': bic_penalty}
 
 
+# Candidate models and memory-mapped packed history for select_models()
+# pool processes.
+_SELECT_WORKER = dict()
+_HISTORY_ARRAYS = ['actions', 'observations', 'lengths']
+
+
+def _init_select_worker(models, history_dir):
+    """Pool initializer for select_models()."""
+    util.init_worker()
+    _SELECT_WORKER['models'] = models
+    _SELECT_WORKER['history'] = tuple(
+        np.load(os.path.join(history_dir, '{}.npy'.format(k)), mmap_mode='r')
+        for k in _HISTORY_ARRAYS)
+
+
+def _select_worker(task):
+    """Run main_estimate() for (model index, restart) in a pool process."""
+    m, restart = task
+    model, model_name, bic_penalty = _SELECT_WORKER['models'][m]
+    res = util.run_functor(main_estimate, (
+        restart, _SELECT_WORKER['history'], model, model_name, bic_penalty))
+    res['model'] = m
+    return res
+
+
+def select_models(models, history, restarts, filepath, processes=None,
+                  full_model=None):
+    """Estimate candidate models, writing results to CSV as they finish.
+
+    The packed history is written to memory-mapped files once, rather than
+    pickled with every task. Rows are appended to the CSV as restarts
+    finish, and the file is sorted by BIC score at the end.
+
+    If full_model is given, its restarts run first, and its best
+    log-likelihood is used as a heuristic bound on the others' (which
+    should restrict it, e.g. by sharing parameters it does not). Once it
+    is done, remaining restarts of any model whose bound minus BIC penalty
+    is below the best BIC score so far are skipped. This is not a true
+    bound: the log-likelihood is a MAP objective with one prior term per
+    parameter, so models with fewer parameters have fewer prior terms, and
+    EM only finds local optima. Pruned models may have won, and get fewer
+    rows (possibly none) in the CSV.
+
+    Args:
+        models:     List of (POMDPModel, model name, BIC penalty).
+        history:    History object.
+        restarts:   Random restarts per model.
+        filepath:   Output CSV path.
+        processes:  Number of pool processes. Defaults to the CPU count.
+        full_model: Index in models of the model all others restrict, to
+                    prune models that are unlikely to win (see above).
+                    Defaults to no pruning.
+
+    Returns:
+        pandas.DataFrame of results, sorted by BIC score.
+
+    """
+    import csv
+    import json
+    import queue
+    import shutil
+    import tempfile
+    import pandas as pd
+    from . import param
+
+    order = list(range(len(models)))
+    if full_model is not None:
+        order.remove(full_model)
+        order.insert(0, full_model)
+    tasks = collections.deque((m, i) for m in order for i in range(restarts))
+    remaining = collections.Counter(m for m, _ in tasks)
+    max_pending = 2 * (processes or multiprocessing.cpu_count())
+    done = queue.Queue()
+
+    ll_bound = None
+    bic_best = float('-inf')
+    ll_best = collections.defaultdict(lambda: float('-inf'))
+    pruned = set()
+    n_pending = 0
+    fieldnames = ['model_name', 'll', 'bic_penalty', 'bic_score',
+                  'params_json']
+
+    history_dir = tempfile.mkdtemp()
+    try:
+        for k, v in zip(_HISTORY_ARRAYS, history.pack()):
+            np.save(os.path.join(history_dir, '{}.npy'.format(k)), v)
+        pool = multiprocessing.Pool(
+            processes=processes, initializer=_init_select_worker,
+            initargs=(models, history_dir))
+        try:
+            with open(filepath, 'w') as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames,
+                                        extrasaction='ignore')
+                writer.writeheader()
+                while tasks or n_pending:
+                    while tasks and n_pending < max_pending:
+                        m, i = tasks.popleft()
+                        if m in pruned:
+                            continue
+                        pool.apply_async(_select_worker, ((m, i),),
+                                         callback=done.put,
+                                         error_callback=done.put)
+                        n_pending += 1
+                    if not n_pending:
+                        break
+                    res = done.get()
+                    n_pending -= 1
+                    if isinstance(res, Exception):
+                        raise res
+
+                    m = res['model']
+                    res['bic_score'] = res['ll'] - res['bic_penalty']
+                    res['params_json'] = json.dumps(
+                        param.Params(res['params']).to_cmd(),
+                        default=lambda v: np.asarray(v).tolist())
+                    writer.writerow(res)
+                    f.flush()
+
+                    remaining[m] -= 1
+                    ll_best[m] = max(ll_best[m], res['ll'])
+                    bic_best = max(bic_best, res['bic_score'])
+                    if full_model is not None and not remaining[full_model]:
+                        ll_bound = ll_best[full_model]
+                    if ll_bound is not None:
+                        for other, (_, model_name, bic_penalty) in \
+                                enumerate(models):
+                            if (remaining[other] and other not in pruned and
+                                    ll_bound - bic_penalty < bic_best):
+                                logging.warning(
+                                    'Pruning %s with %d restarts left',
+                                    model_name, remaining[other])
+                                pruned.add(other)
+        finally:
+            pool.terminate()
+    finally:
+        shutil.rmtree(history_dir)
+
+    df = pd.read_csv(filepath)
+    df = df.sort_values(by='bic_score', ascending=False)
+    df.to_csv(filepath, index=False)
+    return df
+
+
 def main():
     """Run passive simulator and estimate parameters.
 
@@ -960,10 +1790,8 @@ def main():
     """
     import argparse
     import itertools
-    import multiprocessing
     import json
     import os
-    from .history import History
     from .exp import add_config_argparse_group
     from . import simulator
     from . import param
@@ -973,6 +1801,10 @@ def main():
     parser.add_argument('--restarts', type=int, default=50)
     parser.add_argument('--convert_work_to_quiz', action='store_true')
     parser.add_argument('--processes', type=int)
+    parser.add_argument('--prune', action='store_true',
+                        help=('Skip restarts of models unlikely to win, '
+                              'using the unshared model as a heuristic '
+                              'bound (may drop the best model)'))
     add_config_argparse_group(parser)
 
     parser.add_argument(
@@ -1058,21 +1890,12 @@ def main():
 
 
 
-    pool = multiprocessing.Pool(initializer=util.init_worker, processes=args.processes)
-    import functools as ft
-    f = ft.partial(util.run_functor, main_estimate)
-    res = pool.map(f, itertools.chain(
-        *[zip(range(args.restarts),
-                       itertools.repeat(history),
-                       itertools.repeat(model),
-                       itertools.repeat(model_name),
-                       itertools.repeat(bic_penalty)) for model, model_name, bic_penalty in zip(models_all, model_names, bic_penalties)]))
-    import pandas as pd
-    df = pd.DataFrame(res)
-    df['bic_score'] = df['ll'] - df['bic_penalty']
-    df['params_json'] = df['params'].map(lambda p: json.dumps(param.Params(p).to_cmd()))
-    df.sort_values(by='bic_score', ascending=False).to_csv(
-        os.path.join(result_dir, '{}.csv'.format(args.name)), index=False)
+    select_models(
+        list(zip(models_all, model_names, bic_penalties)), history,
+        restarts=args.restarts,
+        filepath=os.path.join(result_dir, '{}.csv'.format(args.name)),
+        processes=args.processes,
+        full_model=len(models_all) - 1 if args.prune else None)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,58 @@
+"""scheduler.py
+
+Background scheduler for policy solves.
+
+"""
+import concurrent.futures
+import logging
+import threading
+
+
+class SolveScheduler(object):
+    """Run solves in background threads, at most one pending per key.
+
+    Submitting a key that already has a queued or running solve returns
+    the existing future instead of starting another solve, so many
+    concurrent requests for the same config trigger a single solve.
+
+    """
+    def __init__(self, max_workers=1):
+        """Initialize.
+
+        Args:
+            max_workers (int):  Maximum number of solves run concurrently.
+
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) unless key is already pending.
+
+        Returns:
+            concurrent.futures.Future for the pending solve.
+
+        """
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(fn, *args, **kwargs)
+            self._pending[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def pending(self, key):
+        """Return whether a solve for key is queued or running."""
+        with self._lock:
+            return key in self._pending
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        if not future.cancelled() and future.exception() is not None:
+            logging.error('Solve for %s failed', key,
+                          exc_info=future.exception())
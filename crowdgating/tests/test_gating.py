@@ -6,7 +6,9 @@ Assume tutorial of size 5 and screening of size 10.
 import os
 import unittest
 import json
+import random
 from crowdgating import gating
+from crowdgating.gate import Gate
 
 PARAMS = {
     'n_tutorial': 5,
@@ -188,3 +190,227 @@ class WorkTest(unittest.TestCase):
                 self.assertIsNone(action)
             else:
                 self.assertFalse(action['test'])
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {}
+        self.params.update(PARAMS)
+        self.params['seed'] = 0
+        self.gate = Gate(**self.params)
+
+    def test_incremental(self):
+        rng = random.Random(0)
+        history = {'tutorial': [], 'screening': [], 'work': []}
+        state = self.gate.new_state()
+        for _ in range(300):
+            action = self.gate.next(history, seed=0)
+            self.assertEqual(self.gate.next(state, seed=0), action)
+            if action is None:
+                break
+            elif 'tutorial' in action:
+                answer = rng.random() < 0.8
+                history['tutorial'].append(answer)
+                state.add_tutorial(answer)
+            elif 'screening' in action:
+                answer = rng.random() < 0.9
+                history['screening'].append(answer)
+                state.add_screening(answer)
+            else:
+                answer = rng.random() < 0.9 if action['test'] else None
+                history['work'].append(answer)
+                state.add_work(answer)
+        self.assertGreater(state.n_work, 20)
+
+    def test_sliding_window(self):
+        work = [None, True, False] * 50 + [True] * 3
+        state = gating.GateState.from_history(
+            tutorial=None, screening=None, work=work, n_gold_sliding=10)
+        tests = [x for x in work if x is not None][-10:]
+        self.assertEqual(list(state.gold), tests)
+        self.assertEqual(state.n_gold_right, sum(tests))
+        self.assertEqual(state.passes_gold(0.8),
+                         gating._passes_gold(work, 10, 0.8))
+
+
+class GoldScheduleTest(unittest.TestCase):
+
+    def test_global_random_untouched(self):
+        random.seed(123)
+        expected = random.random()
+        random.seed(123)
+        for seed in [None, 0]:
+            for gold_schedule in gating.GOLD_SCHEDULES:
+                gating.gold_positions(
+                    batch_index=1, batch_size=20, gold_per_batch=5,
+                    seed=seed, gold_schedule=gold_schedule)
+        self.assertEqual(random.random(), expected)
+
+    def test_unseeded_not_cached(self):
+        gating._gold_positions_cached.cache_clear()
+        for _ in range(10):
+            gating.gold_positions(
+                batch_index=0, batch_size=20, gold_per_batch=5)
+        self.assertEqual(gating._gold_positions_cached.cache_info().currsize,
+                         0)
+
+    def test_sample(self):
+        positions = [
+            gating.gold_positions(
+                batch_index=b, batch_size=10**6, gold_per_batch=5, seed=7,
+                gold_schedule='sample')
+            for b in range(3)
+        ]
+        for p in positions:
+            self.assertEqual(len(p), 5)
+            self.assertTrue(all(0 <= i < 10**6 for i in p))
+        self.assertEqual(
+            positions[0],
+            gating.gold_positions(
+                batch_index=0, batch_size=10**6, gold_per_batch=5, seed=7,
+                gold_schedule='sample'))
+        self.assertNotEqual(positions[0], positions[1])
+
+    def test_gate_sample(self):
+        params = dict(PARAMS, n_tutorial=0, n_screening=0)
+        gate = Gate(seed=0, gold_schedule='sample', **params)
+        state = gate.new_state()
+        for _ in range(PARAMS['batch_size']):
+            action = gate.next(state, seed=0)
+            state.add_work(True if action['test'] else None)
+        self.assertEqual(len(state.gold), PARAMS['gold_per_batch'])
+        with self.assertRaises(ValueError):
+            Gate(gold_schedule='bogus')
+
+
+def random_history(rng):
+    return {
+        'tutorial': [rng.random() < 0.8 for _ in range(rng.randint(0, 6))],
+        'screening': [rng.random() < 0.85 for _ in range(rng.randint(0, 11))],
+        'work': [rng.choice([None, None, True, True, False])
+                 for _ in range(rng.randint(0, 200))],
+    }
+
+
+class NextManyTest(unittest.TestCase):
+
+    def test_matches_next(self):
+        rng = random.Random(0)
+        histories = [random_history(rng) for _ in range(500)]
+        for exponential_backoff in [True, False]:
+            params = dict(PARAMS, exponential_backoff=exponential_backoff)
+            gate = Gate(seed=3, **params)
+            expected = [gate.next(h, seed=0) for h in histories]
+            self.assertEqual(gate.next_many(histories, seed=0), expected)
+            states = [gate.get_state(h) for h in histories]
+            self.assertEqual(gate.next_many(states, seed=0), expected)
+
+    def test_empty(self):
+        self.assertEqual(Gate(**PARAMS).next_many([]), [])
+
+
+class GatingScheduleTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        for exponential_backoff in [True, False]:
+            for gold_schedule in gating.GOLD_SCHEDULES:
+                schedule = gating.GatingSchedule(
+                    batch_size=7, gold_per_batch=2,
+                    exponential_backoff=exponential_backoff,
+                    gold_schedule=gold_schedule)
+                gold = [schedule.is_gold(k, seed=5) for k in range(200)]
+                for k in range(100):
+                    self.assertEqual(
+                        schedule.n_gold_before(k, seed=5), sum(gold[:k]))
+                    self.assertEqual(
+                        schedule.next_gold(k, seed=5),
+                        k + gold[k:].index(True))
+
+    def test_no_gold(self):
+        schedule = gating.GatingSchedule(
+            batch_size=5, gold_per_batch=0, exponential_backoff=True)
+        self.assertIsNone(schedule.next_gold(3, seed=0))
+        self.assertEqual(schedule.n_gold_before(100, seed=0), 0)
+
+
+class PlanTest(unittest.TestCase):
+
+    def simulate(self, gate, state, k, wrong=()):
+        state = state.copy()
+        actions = []
+        for i in range(k):
+            action = gate.next(state, seed=0)
+            if action is None:
+                break
+            actions.append(action)
+            answer = i not in wrong
+            if 'tutorial' in action:
+                state.add_tutorial(answer)
+            elif 'screening' in action:
+                state.add_screening(answer)
+            else:
+                state.add_work(answer if action['test'] else None)
+        return actions
+
+    def test_plan(self):
+        rng = random.Random(0)
+        k = 30
+        for _ in range(200):
+            params = dict(
+                PARAMS, n_tutorial=rng.randint(0, 3),
+                n_screening=rng.randint(0, 6), batch_size=rng.randint(1, 6),
+                gold_per_batch=rng.randint(0, 3),
+                n_gold_sliding=rng.randint(0, 6),
+                desired_accuracy=rng.choice([0, 0.5, 0.8, 1]),
+                exponential_backoff=rng.random() < 0.5)
+            gate = Gate(seed=0, **params)
+            history = random_history(rng)
+            history['tutorial'] = history['tutorial'][:params['n_tutorial']]
+            history['screening'] = \
+                history['screening'][:params['n_screening']]
+            state = gate.get_state(history)
+            actions, checkpoints = gate.plan(state, k)
+            self.assertEqual(actions, self.simulate(gate, state, k))
+            # Any number of wrong answers away from checkpoints keeps the
+            # plan, however far ahead.
+            for _ in range(10):
+                wrong = set(i for i in range(len(actions))
+                            if rng.random() < 0.5)
+                changed = self.simulate(gate, state, 200, wrong)[:k] != \
+                    actions
+                if changed:
+                    self.assertTrue(wrong & set(checkpoints))
+
+    def test_several_wrong_screening(self):
+        gate = Gate(n_tutorial=0, n_screening=4, desired_accuracy=0.5,
+                    seed=0)
+        state = gate.new_state()
+        actions, checkpoints = gate.plan(state, 6)
+        self.assertEqual(checkpoints, [0, 1, 2, 3])
+        # Boot after screening instead of planned work.
+        self.assertEqual(len(self.simulate(gate, state, 6, {0, 1, 2})), 4)
+
+    def test_several_wrong_gold(self):
+        gate = Gate(n_tutorial=0, n_screening=0, n_gold_sliding=4,
+                    gold_per_batch=4, batch_size=4, desired_accuracy=0.5,
+                    exponential_backoff=False,
+                    seed=0)
+        state = gate.new_state()
+        actions, checkpoints = gate.plan(state, 12)
+        tests = [i for i, a in enumerate(actions) if a['test']]
+        self.assertEqual(len(tests), 12)
+        self.assertEqual(checkpoints, tests)
+        self.assertLess(len(self.simulate(gate, state, 12, {0, 1, 2})), 12)
+
+    def test_seed(self):
+        history = {'work': [None] * 5}
+        with self.assertRaises(ValueError):
+            Gate().plan(history, 10)
+        self.assertEqual(Gate().plan(history, 40, seed=3),
+                         Gate().plan(history, 40, seed=3))
+        gate = Gate(seed=1)
+        actions, _ = gate.plan(history, 40)
+        self.assertEqual(actions, gate.plan(history, 40, seed=2)[0])
+        self.assertEqual(
+            actions, self.simulate(gate, gate.get_state(history), 40))
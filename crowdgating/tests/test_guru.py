@@ -0,0 +1,155 @@
+"""Test Guru policy registry."""
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from crowdgating import guru
+from crowdgating.policy_cache import PolicyCache
+from crowdgating.pomdp import POMDPPolicy
+from crowdgating.scheduler import SolveScheduler
+
+SAMPLE_POLICY = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'policies', 'sample.policy')
+
+
+def load_sample_policy(pol):
+    pol.external_policy = POMDPPolicy(
+        SAMPLE_POLICY, file_format='zmdp', n_states=len(pol.model.states))
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        guru._POLICIES.clear()
+
+    def test_solved_once(self):
+        with mock.patch.object(guru, '_solve',
+                               side_effect=load_sample_policy) as solve:
+            key, pol = guru.get_policy(0.8)
+            self.assertEqual(guru.get_policy(0.8), (key, pol))
+            self.assertEqual(solve.call_count, 1)
+            self.assertNotEqual(guru.get_policy(0.9)[0], key)
+            self.assertEqual(solve.call_count, 2)
+
+    def test_get_action(self):
+        with mock.patch.object(guru, '_solve',
+                               side_effect=load_sample_policy):
+            self.assertEqual(guru.get_action(0.8, []), {'test': False})
+            self.assertEqual(
+                guru.get_action(0.8, [False] * 5, worker_id='w'), None)
+
+    def test_resolve_in_background(self):
+        with mock.patch.object(guru, '_solve',
+                               side_effect=load_sample_policy):
+            _, pol = guru.get_policy(0.8)
+        old = pol.external_policy
+        release = threading.Event()
+
+        def solve(pol):
+            release.wait()
+            load_sample_policy(pol)
+
+        with mock.patch.object(guru, '_solve', side_effect=solve) as s:
+            for _ in range(10):
+                _, pol = guru.get_policy(0.8, resolve=True)
+                self.assertIs(pol.external_policy, old)
+            release.set()
+            guru.get_policy(0.8, resolve=True, wait=True)
+            self.assertLessEqual(s.call_count, 2)
+        self.assertIsNot(pol.external_policy, old)
+
+    def test_first_solve_not_behind_resolve(self):
+        with mock.patch.object(guru, '_solve',
+                               side_effect=load_sample_policy):
+            guru.get_policy(0.8)
+        release = threading.Event()
+
+        def solve(pol):
+            if pol.external_policy is not None:
+                release.wait()
+            load_sample_policy(pol)
+
+        with mock.patch.object(guru, '_solve', side_effect=solve):
+            guru.get_policy(0.8, resolve=True)
+            # Returns while the resolve for 0.8 is still running.
+            _, pol = guru.get_policy(0.9)
+            self.assertIsNotNone(pol.external_policy)
+            release.set()
+            guru.get_policy(0.8, resolve=True, wait=True)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_deduplicate(self):
+        scheduler = SolveScheduler(max_workers=4)
+        release = threading.Event()
+        calls = []
+
+        def solve():
+            release.wait()
+            calls.append(None)
+
+        futures = [scheduler.submit('key', solve) for _ in range(100)]
+        self.assertTrue(scheduler.pending('key'))
+        release.set()
+        for future in futures:
+            future.result()
+        self.assertEqual(len(calls), 1)
+
+
+class PolicyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pol = guru._make_policy(guru.get_config(0.8))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_solver(self, model_filepath, policy_filepath, write_model):
+        self.assertTrue(os.path.exists(model_filepath))
+        self.assertTrue(model_filepath.endswith('.pomdp'))
+        shutil.copy(SAMPLE_POLICY, policy_filepath)
+        return self.pol.load_policy(policy_filepath)
+
+    def test_hit(self):
+        cache = PolicyCache(self.path)
+        with mock.patch.object(self.pol, 'run_solver',
+                               side_effect=self.run_solver) as solve:
+            cache.get_policy(self.pol)
+            cache.get_policy(self.pol)
+            self.assertEqual(solve.call_count, 1)
+            self.pol.discount = 0.95
+            cache.get_policy(self.pol)
+            self.assertEqual(solve.call_count, 2)
+        self.assertEqual(os.listdir(cache.scratch_path), [])
+        self.assertEqual(len(glob.glob(os.path.join(self.path, '*.bin'))), 2)
+
+    def test_evict(self):
+        cache = PolicyCache(self.path, max_bytes=1)
+        with mock.patch.object(self.pol, 'run_solver',
+                               side_effect=self.run_solver):
+            cache.get_policy(self.pol)
+            self.pol.discount = 0.95
+            cache.get_policy(self.pol)
+        self.assertEqual(len(glob.glob(os.path.join(self.path, '*.bin'))), 1)
+
+    def test_not_solved(self):
+        self.pol.policy = 'fixed'
+        with self.assertRaises(ValueError):
+            PolicyCache(self.path).get_policy(self.pol)
+
+    def test_stale_scratch(self):
+        cache = PolicyCache(self.path, max_scratch_age=60)
+        os.makedirs(cache.scratch_path)
+        stale = os.path.join(cache.scratch_path, 'stale.pomdp')
+        fresh = os.path.join(cache.scratch_path, 'fresh.pomdp')
+        for filepath in [stale, fresh]:
+            with open(filepath, 'w') as f:
+                f.write('x')
+        os.utime(stale, (0, 0))
+        cache.evict()
+        self.assertEqual(os.listdir(cache.scratch_path), ['fresh.pomdp'])
@@ -0,0 +1,58 @@
+"""Test Policy."""
+import unittest
+from unittest import mock
+import numpy as np
+from crowdgating import guru
+from crowdgating import param
+from crowdgating.policy import Policy
+from crowdgating.tests.test_pomdp import make_history
+
+
+class PrepWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        params = param.Params.from_cmd(guru.get_config(0.8))
+        self.policy = Policy(
+            policy_type='work_only',
+            n_worker_classes=params.n_classes,
+            params_gt=params.get_param_dict(sample=False),
+            thompson=True,
+            hyperparams='HyperParams')
+
+    def test_online(self):
+        np.random.seed(0)
+        history = make_history(n_workers=3)
+        for worker in range(3, 6):
+            self.policy.prep_worker(None, None, history, resolve_p=True,
+                                    online=True)
+            history.history.extend(make_history(n_workers=1,
+                                                seed=worker).history)
+        self.assertEqual(sorted(self.policy.params_estimated), [2, 3, 4])
+        self.assertEqual(self.policy.model.online_workers, 5)
+        for params in self.policy.params_estimated.values():
+            for p in params:
+                self.assertAlmostEqual(sum(params[p]), 1)
+
+    def test_warm_start(self):
+        """Warm-started EM reuses E-step results of earlier workers."""
+        np.random.seed(0)
+        history = make_history(n_workers=5)
+        model = self.policy.model
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.policy.prep_worker(None, None, history, resolve_p=True)
+            history.history.extend(make_history(n_workers=1).history)
+            with mock.patch.object(model, 'forward_backward',
+                                   wraps=model.forward_backward) as f:
+                self.policy.prep_worker(None, None, history, resolve_p=True,
+                                        resolve_random_restarts=0)
+        self.assertEqual(len(f.call_args_list[0][0][3]), 1)
+
+    def test_posterior_only(self):
+        np.random.seed(0)
+        history = make_history(n_workers=3)
+        with mock.patch.object(self.policy.model, 'estimate') as estimate:
+            self.policy.prep_worker(None, None, history, resolve_p=True,
+                                    posterior_only=True)
+        estimate.assert_not_called()
+        self.assertEqual(self.policy.model.posterior_workers, 3)
+        self.assertIn(2, self.policy.hparams_estimated)
@@ -0,0 +1,517 @@
+"""Test POMDP model."""
+import copy
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from scipy.special import logsumexp
+from crowdgating import guru
+from crowdgating import param
+from crowdgating.belief_cache import BeliefCache
+from crowdgating.ess_cache import ESSCache
+from crowdgating.history import History
+from crowdgating import zmdp_util
+from crowdgating.pomdp import POMDPModel, POMDPPolicy, select_models
+
+SAMPLE_POLICY = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'policies', 'sample.policy')
+
+
+def make_model(desired_accuracy=0.8):
+    config = guru.get_config(desired_accuracy)
+    del config['zmdp_discount'], config['zmdp_timeout']
+    params = param.Params.from_cmd(config)
+    params_dict = params.get_param_dict(sample=False)
+    return POMDPModel(params.n_classes, params=params_dict,
+                      hyperparams=param.HyperParams(params_dict,
+                                                    params.n_classes))
+
+
+def make_history(n_workers=5, seed=0):
+    """Random work / test histories for the default one-skill model."""
+    rng = np.random.RandomState(seed)
+    history = History()
+    for _ in range(n_workers):
+        history.new_worker()
+        for _ in range(rng.randint(1, 12)):
+            if rng.rand() < 0.5:
+                history.record(1, 0)
+            else:
+                history.record(2, rng.choice([2, 3]))
+    return history
+
+
+class TablesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+
+    def test_matches_scalar(self):
+        p_t, p_o, p_i = self.model.get_tables()
+        rewards = self.model.get_reward_table()
+        S = len(self.model.states)
+        for s in range(S):
+            self.assertAlmostEqual(p_i[s],
+                                   self.model.get_start_probability(s))
+            for a in range(len(self.model.actions)):
+                for s1 in range(S):
+                    self.assertAlmostEqual(
+                        p_t[s, a, s1], self.model.get_transition(s, a, s1))
+                    self.assertAlmostEqual(
+                        rewards[s, a, s1],
+                        sum(self.model.get_reward(s, a, s1)[0]))
+                for o in range(len(self.model.observations)):
+                    self.assertAlmostEqual(
+                        p_o[s, a, o], self.model.get_observation(s, a, o))
+
+    def test_cached(self):
+        self.assertIs(self.model.get_tables()[0], self.model.get_tables()[0])
+
+    def test_invalidated_on_param_change(self):
+        p_t = self.model.get_tables()[0]
+        self.model.params[('p_leave', None)] = [0.2, 0.8]
+        p_t_new = self.model.get_tables()[0]
+        self.assertIsNot(p_t, p_t_new)
+        self.assertAlmostEqual(p_t_new[1, 1, 0], 0.2)
+
+
+class BeliefTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.history = make_history()
+
+    def test_update_belief(self):
+        belief = self.model.get_start_belief()
+        belief = self.model.update_belief(belief, 2, 3)
+        self.assertAlmostEqual(belief.sum(), 1)
+        # Wrong answer makes the low-accuracy worker class more likely.
+        self.assertGreater(belief[4], self.model.get_start_belief()[2])
+
+    def test_get_beliefs_matches_sequential(self):
+        beliefs = self.model.get_beliefs(self.history)
+        self.assertEqual(beliefs.shape, (self.history.n_workers(),
+                                         len(self.model.states)))
+        for worker, worker_AO in enumerate(self.history.history):
+            belief = self.model.get_start_belief()
+            for a, o, _ in worker_AO:
+                belief = self.model.update_belief(belief, a, o)
+            np.testing.assert_allclose(beliefs[worker], belief)
+
+
+class MarginalsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.history = make_history()
+
+    def test_likelihood(self):
+        """Likelihood matches the product of filtering normalizers."""
+        p_t, p_o, _ = self.model.get_tables()
+        expected = 0
+        for worker_AO in self.history.history:
+            belief = np.array(self.model.get_start_belief())
+            for a, o, _ in worker_AO:
+                joint = belief.dot(p_t[:, a, :]) * p_o[:, a, o]
+                expected += np.log(joint.sum())
+                belief = joint / joint.sum()
+        _, _, ll = self.model.get_unnormalized_marginals(
+            self.model.params, self.history)
+        self.assertAlmostEqual(ll, expected)
+
+    def test_marginals_consistent(self):
+        log_marginals, log_pairwise_marginals, _ = \
+            self.model.get_unnormalized_marginals(
+                self.model.params, self.history)
+        for lm, lpm in zip(log_marginals, log_pairwise_marginals):
+            worker_ll = logsumexp(lm[0])
+            np.testing.assert_allclose(logsumexp(lm, axis=1), worker_ll)
+            np.testing.assert_allclose(
+                logsumexp(lpm, axis=(1, 2)), worker_ll)
+            np.testing.assert_allclose(logsumexp(lpm, axis=2), lm[:-1])
+
+    def test_forward_backward(self):
+        log_marginals, log_pairwise_marginals, ll = \
+            self.model.get_unnormalized_marginals(
+                self.model.params, self.history)
+        expected = self.model.expected_sufficient_statistics(
+            log_marginals, log_pairwise_marginals, self.history)
+        self.history.new_worker()
+        actions, observations, lengths = self.history.pack()
+        self.assertEqual(actions.shape, (6, lengths.max()))
+        self.assertEqual(lengths[-1], 0)
+        result = self.model.forward_backward(
+            self.model.params, actions, observations, lengths)
+        for v, v_expected in zip(result, expected + (ll,)):
+            np.testing.assert_allclose(v, v_expected)
+
+    def test_ess_streamed(self):
+        """Generators work, and empty workers do not shift the rest."""
+        self.history.history.insert(1, [])
+        expected = self.model.forward_backward(
+            self.model.params, *self.history.pack())
+        marginals = self.model.iter_unnormalized_marginals(
+            self.model.params, self.history)
+        m, pm = itertools.tee(marginals)
+        result = self.model.expected_sufficient_statistics(
+            (x[0] for x in m), (x[1] for x in pm), self.history)
+        for v, v_expected in zip(result, expected):
+            np.testing.assert_allclose(v, v_expected)
+
+
+class MStepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+
+    def test_matches_scalar(self):
+        S = len(self.model.states)
+        A = len(self.model.actions)
+        O = len(self.model.observations)
+        rng = np.random.RandomState(0)
+        ess_t = rng.rand(S, A, S)
+        ess_o = rng.rand(S, A, O)
+        ess_i = rng.rand(S)
+        expected = dict((p, np.array(v, dtype=float)) for
+                        p, v in self.model.hyperparams.p.items())
+        cells = [(self.model.get_start_probability(s, exponents=True),
+                  ess_i[s]) for s in range(S)]
+        for s in range(S):
+            for a in range(A):
+                cells.extend(
+                    (self.model.get_transition(s, a, s1, exponents=True),
+                     ess_t[s, a, s1]) for s1 in range(S))
+                cells.extend(
+                    (self.model.get_observation(s, a, o, exponents=True),
+                     ess_o[s, a, o]) for o in range(O))
+        for exponents, v in cells:
+            for p in exponents:
+                expected[p] += v * np.array(exponents[p])
+
+        params, hparams = self.model.estimate_M(ess_t, ess_o, ess_i)
+        self.assertEqual(set(hparams), set(expected))
+        for p in expected:
+            np.testing.assert_allclose(hparams[p], expected[p])
+            self.assertAlmostEqual(params[p].sum(), 1)
+
+    def test_estimate(self):
+        np.random.seed(0)
+        history = make_history(n_workers=20)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ll, params = self.model.estimate(history, random_restarts=1)
+        self.assertTrue(np.isfinite(ll))
+        for p in params:
+            self.assertAlmostEqual(sum(params[p]), 1)
+
+    def test_estimate_processes(self):
+        history = make_history(n_workers=20)
+        results = []
+        for processes in [None, 2]:
+            np.random.seed(0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results.append(make_model().estimate(
+                    history, random_restarts=3, processes=processes))
+        self.assertEqual(results[0][0], results[1][0])
+        for p in results[0][1]:
+            np.testing.assert_array_equal(results[0][1][p],
+                                          results[1][1][p])
+
+
+class OnlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.history = make_history(n_workers=20)
+
+    def test_first_update(self):
+        """First update is one EM iteration from the current parameters."""
+        params = self.model.get_params_est()
+        ess_t, ess_o, ess_i, _ = self.model.forward_backward(
+            params, *self.history.pack())
+        expected, _ = self.model.estimate_M(ess_t, ess_o, ess_i)
+        _, params = self.model.estimate_online(self.history)
+        for p in expected:
+            np.testing.assert_allclose(params[p], expected[p])
+
+    def test_new_workers_only(self):
+        self.model.estimate_online(self.history)
+        params = copy.deepcopy(self.model.get_params_est())
+        _, params_same = self.model.estimate_online(self.history)
+        for p in params:
+            np.testing.assert_array_equal(params_same[p], params[p])
+
+        new_workers = make_history(n_workers=2, seed=1)
+        self.history.history.extend(new_workers.history)
+        ll, _ = self.model.estimate_online(self.history)
+        _, _, expected_ll = self.model.get_unnormalized_marginals(
+            params, new_workers)
+        self.assertAlmostEqual(ll, expected_ll)
+        self.assertEqual(self.model.online_workers, 22)
+        self.assertEqual(self.model.online_updates, 2)
+
+
+class PosteriorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.history = make_history(n_workers=10)
+
+    def test_counts(self):
+        """Posterior counts match the M-step at the same parameters."""
+        ess_t, ess_o, ess_i, _ = self.model.forward_backward(
+            self.model.get_params_est(), *self.history.pack())
+        _, expected = self.model.estimate_M(ess_t, ess_o, ess_i)
+        hparams = self.model.update_posterior(self.history)
+        for p in expected:
+            np.testing.assert_allclose(hparams[p], expected[p])
+
+    def test_incremental(self):
+        """Workers are added under the parameters current at the time."""
+        params_first = copy.deepcopy(self.model.get_params_est())
+        self.model.update_posterior(self.history)
+        self.model.thompson_sample()
+        params_new = copy.deepcopy(self.model.get_params_est())
+        self.history.history.extend(make_history(n_workers=4, seed=1).history)
+        hparams = self.model.update_posterior(self.history)
+        self.assertEqual(self.model.posterior_workers, 14)
+
+        ess_first = self.model.forward_backward(
+            params_first, *self.history.pack(range(10)))
+        ess_new = self.model.forward_backward(
+            params_new, *self.history.pack(range(10, 14)))
+        expected = self.model.get_posterior_counts(
+            *[a + b for a, b in zip(ess_first[:3], ess_new[:3])])
+        for p in expected:
+            np.testing.assert_allclose(hparams[p], expected[p])
+
+
+class RaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.history = make_history(n_workers=20)
+        self.tasks = [(True, 0.001, seed) for seed in range(4)]
+
+    def test_no_pruning(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = self.model.estimate_race(
+                self.history, self.tasks, race_iterations=1,
+                race_margin=np.inf)
+            for task, (_, _, ll) in zip(self.tasks, results):
+                _, _, expected = self.model.estimate_once(
+                    self.history, *task)
+                self.assertEqual(ll, expected)
+
+    def test_pruning(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results = self.model.estimate_race(
+                self.history, self.tasks, race_iterations=1, race_margin=0)
+            lls = [self.model.estimate_once(self.history, *task)[2] for
+                   task in self.tasks]
+        # Only the leader after one iteration runs to convergence.
+        self.assertEqual(sum(ll == r[2] for ll, r in zip(lls, results)), 1)
+
+    def test_processes(self):
+        with self.assertRaises(ValueError):
+            self.model.estimate(self.history, race_iterations=1, processes=2)
+
+
+class ESSCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.params = self.model.get_params_est()
+        self.history = make_history(n_workers=10)
+        self.history.history.insert(3, [])
+
+    def test_matches(self):
+        cache = ESSCache()
+        expected = self.model.forward_backward(
+            self.params, *self.history.pack())
+        cache.put_ess(self.params, self.history.pack()[2], expected)
+        for _ in range(2):
+            result = cache.get_ess(self.model, self.params,
+                                   *self.history.pack())
+            for v, v_expected in zip(result, expected):
+                np.testing.assert_allclose(v, v_expected)
+
+    def test_new_workers_only(self):
+        cache = ESSCache()
+        cache.put_ess(self.params, self.history.pack()[2],
+                      cache.get_ess(self.model, self.params,
+                                    *self.history.pack()))
+        self.history.history.extend(make_history(n_workers=2).history)
+        with mock.patch.object(self.model, 'forward_backward',
+                               wraps=self.model.forward_backward) as f:
+            cache.get_ess(self.model, self.params, *self.history.pack())
+        self.assertEqual(len(f.call_args[0][3]), 2)
+
+    def test_evict(self):
+        cache = ESSCache()
+        ess = self.model.forward_backward(self.params, *self.history.pack())
+        cache.put_ess(self.params, self.history.pack()[2], ess)
+        cache.max_bytes = cache.n_bytes
+        params = dict(self.params, p_worker=[0.7, 0.3])
+        cache.put_ess(params, self.history.pack()[2], ess)
+        self.assertLessEqual(cache.n_bytes, cache.max_bytes)
+        self.assertEqual(len(cache._entries), 1)
+        self.assertEqual(len(pickle.loads(pickle.dumps(cache))._entries), 0)
+
+    def test_estimate_warm_start(self):
+        self.model.ess_cache = ESSCache()
+        np.random.seed(0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.model.estimate(self.history, random_restarts=1)
+            # Only the final E-step of the best run is stored.
+            self.assertEqual(len(self.model.ess_cache._entries), 1)
+            self.history.history.extend(make_history(n_workers=2).history)
+            with mock.patch.object(self.model, 'forward_backward',
+                                   wraps=self.model.forward_backward) as f:
+                self.model.estimate(self.history, random_restarts=0)
+        self.assertEqual(len(f.call_args_list[0][0][3]), 2)
+        self.assertEqual(len(self.model.ess_cache._entries), 2)
+        np.testing.assert_allclose(
+            self.model.estimate_E(self.history, self.model.params_em,
+                                  use_cache=True)[0],
+            self.model.estimate_E(self.history, self.model.params_em)[0])
+
+
+class BeliefCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = make_model()
+        self.history = make_history(n_workers=2)
+        self.expected = self.model.get_beliefs(self.history)
+
+    def get_beliefs(self, cache, worker):
+        steps = self.history.history[worker]
+        return [cache.get_belief(self.model, worker, steps[:t])
+                for t in range(len(steps) + 1)]
+
+    def test_extend(self):
+        cache = BeliefCache()
+        for worker in range(2):
+            beliefs = self.get_beliefs(cache, worker)
+            np.testing.assert_allclose(beliefs[-1], self.expected[worker])
+
+    def test_rewritten_history(self):
+        cache = BeliefCache()
+        cache.get_belief(self.model, 0, self.history.history[1])
+        np.testing.assert_allclose(
+            cache.get_belief(self.model, 0, self.history.history[0]),
+            self.expected[0])
+
+    def test_changed_last_step(self):
+        cache = BeliefCache()
+        steps = list(self.history.history[0])
+        cache.get_belief(self.model, 0, steps)
+        steps[-1] = (2, 3) if steps[-1][:2] != (2, 3) else (2, 2)
+        history = History()
+        history.new_worker()
+        for step in steps:
+            history.record(*step)
+        np.testing.assert_allclose(
+            cache.get_belief(self.model, 0, steps),
+            self.model.get_beliefs(history)[0])
+
+    def test_disk(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.get_beliefs(BeliefCache(path=path), 0)
+            cache = BeliefCache(path=path)
+            self.assertIsNotNone(cache._get(0))
+            np.testing.assert_allclose(
+                cache.get_belief(self.model, 0, self.history.history[0]),
+                self.expected[0])
+        finally:
+            shutil.rmtree(path)
+
+
+class ZMDPPolicyTest(unittest.TestCase):
+
+    def test_read(self):
+        actions, alphas, support = zmdp_util.read_zmdp_policy(
+            SAMPLE_POLICY, 9)
+        self.assertEqual(actions.tolist(), [0, 1, 1, 0, 1, 0, 1])
+        self.assertEqual(alphas.dtype, np.float64)
+        self.assertEqual(support.dtype, bool)
+        self.assertTrue(support[0].all())
+        self.assertEqual(np.flatnonzero(support[1]).tolist(), [1, 2, 5, 6])
+        self.assertAlmostEqual(alphas[1, 2], -0.204384)
+        self.assertEqual(alphas[1, 3], 0)
+
+    def test_action_rewards(self):
+        policy = POMDPPolicy(SAMPLE_POLICY, file_format='zmdp', n_states=9)
+        belief = np.zeros(9)
+        belief[[1, 2]] = [0.8, 0.2]
+        rewards = policy.get_action_rewards(belief)
+        self.assertEqual(set(rewards), {0, 1})
+        self.assertAlmostEqual(rewards[0], 0.83122)
+        self.assertAlmostEqual(rewards[1], 0.8 * 1.10062 - 0.2 * 0.204384)
+
+    def test_action_rewards_batch(self):
+        policy = POMDPPolicy(SAMPLE_POLICY, file_format='zmdp', n_states=9)
+        rng = np.random.RandomState(0)
+        beliefs = rng.dirichlet(np.ones(9), size=20) * (rng.rand(20, 9) < 0.5)
+        beliefs = beliefs[beliefs.sum(axis=1) > 0]
+        beliefs /= beliefs.sum(axis=1, keepdims=True)
+        actions, rewards = policy.get_action_rewards_batch(beliefs)
+        for belief, row in zip(beliefs, rewards):
+            expected = policy.get_action_rewards(belief)
+            for a, r in zip(actions, row):
+                if a in expected:
+                    self.assertAlmostEqual(r, expected[a])
+                else:
+                    self.assertEqual(r, -np.inf)
+
+    def test_binary(self):
+        policy = POMDPPolicy(SAMPLE_POLICY, file_format='zmdp', n_states=9)
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'sample.bin')
+            policy.write_binary(filename)
+            binary = POMDPPolicy(filename, file_format='binary')
+            self.assertIsInstance(binary.pMatrix, np.memmap)
+            self.assertEqual(binary.action_nums, policy.action_nums)
+            np.testing.assert_array_equal(binary.pMatrix, policy.pMatrix)
+            np.testing.assert_array_equal(binary.support, policy.support)
+            belief = np.zeros(9)
+            belief[[3, 4]] = [0.5, 0.5]
+            self.assertEqual(binary.get_action_rewards(belief),
+                             policy.get_action_rewards(belief))
+        finally:
+            shutil.rmtree(path)
+
+
+class SelectModelsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.path, 'results.csv')
+        self.history = make_history(n_workers=10)
+        self.models = [(make_model(), 'a', 1.0), (make_model(), 'b', 2.0),
+                       (make_model(), 'c', 1e6)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_all(self):
+        df = select_models(self.models, self.history, restarts=2,
+                           filepath=self.filepath, processes=1)
+        self.assertEqual(sorted(df['model_name']), list('aabbcc'))
+        self.assertEqual(df['bic_score'].tolist(),
+                         sorted(df['bic_score'], reverse=True))
+        self.assertEqual(len(pd.read_csv(self.filepath)), 6)
+
+    def test_prune(self):
+        df = select_models(self.models, self.history, restarts=2,
+                           filepath=self.filepath, processes=1, full_model=0)
+        # Model c cannot beat model a's BIC score. With one process, at
+        # most the restarts already submitted when a finishes run.
+        self.assertLess(sum(df['model_name'] == 'c'), 2)
+        self.assertEqual(sum(df['model_name'] == 'a'), 2)
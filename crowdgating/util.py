@@ -1,4 +1,6 @@
 """util.py"""
+import os
+
 
 def get_penalty(accuracy, reward=1):
     """Return penalty needed for this accuracy to have expected reward 0.
@@ -13,6 +15,36 @@ def get_penalty(accuracy, reward=1):
     """
     return accuracy * reward / (accuracy - 1)
 
+def dirichlet_mode(alpha):
+    """Return mode of a Dirichlet distribution.
+
+    >>> dirichlet_mode([3, 2]).tolist()
+    [0.6666666666666666, 0.3333333333333333]
+
+    """
+    import numpy as np
+    alpha = np.asarray(alpha, dtype=float)
+    return (alpha - 1) / (alpha.sum() - len(alpha))
+
+def init_worker():
+    """Ignore interrupts in pool processes, so the parent handles them."""
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_functor(functor, *args, **kwargs):
+    """Run functor, keeping the traceback of any exception.
+
+    Exceptions raised in pool processes otherwise reach the parent without
+    the traceback of where they happened.
+
+    """
+    import sys
+    import traceback
+    try:
+        return functor(*args, **kwargs)
+    except Exception:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
 def ensure_dir(directory):
     if not os.path.exists(directory):
         os.makedirs(directory) 
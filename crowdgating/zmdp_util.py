@@ -8,45 +8,91 @@
     :description: zMDP utilities (http://www.cs.cmu.edu/~trey/zmdp/)
 """
 
-import io
+import array
 import re
-import yaml
+import numpy as np
+
+_TOKEN = re.compile(r'"[^"]*"|[A-Za-z_]\w*|[-+.\w]+|[{}\[\]]')
+_BRACKETS = re.compile(r'[{}\[\]]')
+
 
 def read_zmdp_policy(filename, state_count):
     """
-    return list of alphavectors and corresponding actions from zMDP policy file
+    return actions, alpha vectors, and alpha vector support from zMDP
+    policy file
 
     zMDP info: http://www.cs.cmu.edu/~trey/zmdp/
 
+    Reads the MaxPlanesLowerBound format in a single pass over the file,
+    without building intermediate Python structures per plane.
+
     arguments:
         filename
+        state_count
+
+    returns:
+        actions:    int array with the action of each plane
+        alphas:     float64 array (planes x states), with 0 for entries
+                    the plane does not define
+        support:    bool array (planes x states), True for entries the
+                    plane defines
     """
-    alpha_vectors, alpha_vector_actions = [], []
-    yaml_data = io.StringIO()
-    yaml_str = ""
-    # read and convert zMDP policy format to YAML
-    with open(filename,'r') as f:
-        zmdp_data = f.read()
-        yaml_data.write( u'%s' % re.sub('=>',':',zmdp_data) )
-        yaml_str += re.sub('=>',':',zmdp_data)
-
-    # read YAML
-    dataMap = yaml.load(yaml_str)
+    policy_type = None
+    key = None
+    depth = 0
+    plane = -1
+    actions = array.array('l')
+    plane_indices = array.array('l')
+    state_indices = array.array('l')
+    values = array.array('d')
+    entry_state = None
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0]
+            if key == 'entries' and not _BRACKETS.search(line):
+                # Fast path for the bulk of the file.
+                tokens = line.replace(',', ' ').split()
+            else:
+                tokens = _TOKEN.findall(line)
+            for token in tokens:
+                if token in '{[':
+                    depth += 1
+                    if token == '{':
+                        key = None
+                        if depth == 3:
+                            plane += 1
+                            actions.append(-1)
+                elif token in '}]':
+                    depth -= 1
+                    key = None
+                elif key == 'entries':
+                    if entry_state is None:
+                        entry_state = int(token)
+                    else:
+                        plane_indices.append(plane)
+                        state_indices.append(entry_state)
+                        values.append(float(token))
+                        entry_state = None
+                elif key == 'action':
+                    actions[plane] = int(token)
+                    key = None
+                elif key == 'policyType':
+                    policy_type = token.strip('"')
+                    key = None
+                elif key is not None:
+                    # Unused scalar, e.g. numPlanes or numEntries.
+                    key = None
+                else:
+                    key = token
 
     # sanity check
-    assert dataMap['policyType'] == 'MaxPlanesLowerBound', 'unrecognized policy'
-
-    # generate cassandra alpha string
-    for plane in dataMap['planes']:
-        alpha_vector_actions.append(int(plane['action']))
-        # since the mdp value is defined only if non zero, we must
-        # manually define the zero values of the alpha vector
-        alpha_vector = [None] * state_count
-        for index in range(int(len(plane['entries'])/2)):  # TODO: J: Added int() here. not sure if that broke anything.
-            actionId = int(plane['entries'][index*2])
-            mdp_value = float(plane['entries'][index*2+1])
-            alpha_vector[actionId] = mdp_value
-        alpha_vectors.append(alpha_vector)
-
-    yaml_data.close()
-    return alpha_vector_actions, alpha_vectors
+    assert policy_type == 'MaxPlanesLowerBound', 'unrecognized policy'
+
+    n_planes = len(actions)
+    plane_indices = np.frombuffer(plane_indices, dtype=plane_indices.typecode)
+    state_indices = np.frombuffer(state_indices, dtype=state_indices.typecode)
+    alphas = np.zeros((n_planes, state_count))
+    support = np.zeros((n_planes, state_count), dtype=bool)
+    alphas[plane_indices, state_indices] = np.frombuffer(values)
+    support[plane_indices, state_indices] = True
+    return np.frombuffer(actions, dtype=actions.typecode).copy(), alphas, support